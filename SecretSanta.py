@@ -8,12 +8,86 @@ from __future__ import print_function
 #
 # Standard imports
 #
+from array import array
+import asyncio
+import bisect
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import datetime
+from email import base64mime
+from email.mime.text import MIMEText
+from email.policy import compat32
+import hashlib
+import heapq
+import itertools
 import json
 import logging
+import math
+import mmap
+import os
+import pickle
+import queue
 import random
+import smtplib
+import socket
+import string
+import struct
+import sys
+import threading
+import time
+import zlib
 #
 # Non-standard imports
 #
+try:
+    import numpy
+except ImportError:
+    # optional, only NumpyPairing needs it
+    numpy = None
+
+#
+##############################################################################
+#
+# Participant()
+#
+class Participant(collections.namedtuple('Participant', 'name email dont_pair wish_list')):
+    '''
+    Participant - compact read-only roster entry, fields in Person() order
+
+    Names are interned, so a name repeated across many dont_pair lists is
+    stored once, and dont_pair is a tuple (or None).
+    '''
+    __slots__ = ()
+
+    FIELDS = ('name', 'email', 'dont_pair', 'wish_list')
+
+    @classmethod
+    def from_dict(cls, entry, where='participant'):
+        '''
+        from_dict() - check and compact one PARTICIPANTS style entry
+
+        Returns:
+            Participant: record for entry, where names it in errors
+        '''
+        if not isinstance(entry, dict):
+            raise RuntimeError("{0}: expected name/email fields, got '{1}'".format(where, entry))
+        unknown = set(entry) - set(cls.FIELDS)
+        if unknown:
+            raise RuntimeError("{0}: unknown fields {1}".format(where, ", ".join(sorted(unknown))))
+        if not entry.get('name') or not entry.get('email'):
+            raise RuntimeError("{0}: name and email are required".format(where))
+
+        dont_pair = entry.get('dont_pair')
+        if isinstance(dont_pair, str):
+            dont_pair = [dont_pair]
+        if dont_pair:
+            dont_pair = tuple(sys.intern(str(name)) for name in dont_pair)
+        else:
+            dont_pair = None
+        return cls(sys.intern(str(entry['name'])), str(entry['email']), dont_pair,
+                   entry.get('wish_list'))
+
 
 #
 ##############################################################################
@@ -24,7 +98,14 @@ import random
 class Person(object):
     '''
     Person - tiny class representing a secret santa participant
+
+    Slotted, with one logger shared by every Person, as rosters can hold
+    tens of thousands of them.
     '''
+    __slots__ = ('name', 'email', 'invalid_matches', 'wish_list', 'uid', 'excluded')
+
+    _logger = logging.getLogger('.'.join([__name__, 'Person']))
+
     def __init__(self, name, email, dont_pair, wish_list=None):
         super(Person, self).__init__()
         self.name = name
@@ -32,7 +113,9 @@ class Person(object):
         self.invalid_matches = dont_pair
         self.wish_list = wish_list
 
-        self._logger = logging.getLogger('.'.join([__name__, self.__class__.__name__]))
+        # filled in by ExclusionIndex
+        self.uid = None
+        self.excluded = None
 
     def __repr__(self):
         return '"{name}" <{email}>'.format(name=self.name, email=self.email)
@@ -46,12 +129,15 @@ class Person(object):
 
     def serialize(self):
         '''
-        serialize() - special serialize call
+        serialize() - special serialize call, a new dict of the public fields
         '''
-        output = self.__dict__
-
-        output.pop('_logger', 0)
-        return output
+        return {
+            'name': self.name,
+            'email': self.email,
+            'invalid_matches': self.invalid_matches,
+            'wish_list': self.wish_list,
+            'uid': self.uid,
+        }
     #
     ##############################################################################
     #
@@ -70,32 +156,40 @@ class Person(object):
     #
     ##############################################################################
     #
+    # can_give_to() - Exclusion check
+    #
+    def can_give_to(self, reciever):
+        '''
+        can_give_to() - True unless reciever is ourself or in our exclusion list
+        '''
+        if self.excluded is not None and reciever.uid is not None:
+            return reciever.uid not in self.excluded
+        if self.name == reciever.name:
+            return False
+        return not (self.invalid_matches and reciever.name in self.invalid_matches)
+    #
+    ##############################################################################
+    #
     # choose_reciever() - Match
     #
     def choose_reciever(self, recievers=None):
         '''
         choose_reciever() - Choose a random Person to give a present to
+
+        Filters out ourself and our exclusion list in one pass and draws
+        once, so the work is bounded by len(recievers).
         '''
         if None not in [recievers]:
 
-            # print("{0} possible:".format(len(recievers)), end='')
-            # print(", ".join([person.name for person in recievers]))
-
-            try:
-                choice = random.choice(recievers)
-            except Exception as err:
-                raise Exception(err)
-
             # Invalid is ourslef or someone in our exclusion list
-            if ((self.name == choice.name) or
-                    (self.invalid_matches and choice.name in self.invalid_matches)):
-                if len(recievers) is 1:
-                    raise Exception('Only one reciever left, try again')
-                self._logger.info("BAD Match '%s' -> '%s'", self, choice)
-                return self.choose_reciever(recievers)
-            else:
-                self._logger.info("Matched '%s' -> '%s'", self, choice)
-                return choice
+            candidates = [reciever for reciever in recievers if self.can_give_to(reciever)]
+            if not candidates:
+                self._logger.info("No valid match for '%s' among %s recievers", self, len(recievers))
+                raise RuntimeError('No valid reciever left, try again')
+
+            choice = random.choice(candidates)
+            self._logger.info("Matched '%s' -> '%s'", self, choice)
+            return choice
         else:
             raise RuntimeError("No recievers provided!")
 #
@@ -108,6 +202,8 @@ class Pair(object):
     '''
     Pair - tiny class representing secret santa assignment
     '''
+    __slots__ = ('giver', 'reciever')
+
     def __init__(self, giver, reciever):
         super(Pair, self).__init__()
         self.giver = giver
@@ -129,10 +225,2026 @@ class Pair(object):
         '''
         if None in [message]:
             raise RuntimeError("No message to format!")
+        elif isinstance(message, MessageTemplate):
+            return message.render(santa=self.giver.name,
+                                  santee=self.reciever.name,
+                                  wish_list=self.reciever.wish_list)
         else:
             return message.format(santa=self.giver.name,
                                   santee=self.reciever.name,
                                   wish_list=self.reciever.wish_list)
+#
+##############################################################################
+#
+# ExclusionIndex()
+#
+class ExclusionIndex(object):
+    '''
+    ExclusionIndex - dont_pair lists compiled once to integer ids
+
+    Every Person gets a uid and a frozenset of the uids it may not give to
+    (its own included), so Person.can_give_to() is an O(1) set lookup.
+    '''
+    def __init__(self, people):
+        super(ExclusionIndex, self).__init__()
+        self._logger = logging.getLogger('.'.join([__name__, self.__class__.__name__]))
+
+        self.people = people
+        self.ids = {}
+        for uid, person in enumerate(people):
+            self.ids.setdefault(person.name, []).append(uid)
+
+        self.excluded = []
+        for uid, person in enumerate(people):
+            excluded = set(self.ids[person.name])
+            for name in person.invalid_matches or []:
+                if name in self.ids:
+                    excluded.update(self.ids[name])
+                else:
+                    self._logger.info("%s: unknown dont_pair name '%s'", person, name)
+            person.uid = uid
+            person.excluded = frozenset(excluded)
+            self.excluded.append(person.excluded)
+
+    def __len__(self):
+        return len(self.people)
+
+    def lookup(self, name):
+        '''lookup() - uids of everyone called name'''
+        return self.ids.get(name, [])
+
+    def allowed(self, giver, reciever):
+        '''allowed() - True if uid giver may give to uid reciever'''
+        return reciever not in self.excluded[giver]
+
+
+#
+##############################################################################
+#
+# ParticipantTable()
+#
+class ParticipantTable(object):
+    '''
+    ParticipantTable - the roster as parallel columns addressed by integer id
+
+    Holds what ExclusionIndex + a list of Person would, without an object
+    per participant: interned names, emails, every wish list in one string
+    cut by offsets, and the dont_pair lists compiled to sorted id runs in
+    one flat array (CSR style, the giver's own ids included). Indexing or
+    iterating gives ParticipantRow views, which the pairing, summary and
+    email code read like a Person.
+    '''
+    def __init__(self, records):
+        super(ParticipantTable, self).__init__()
+        self._logger = logging.getLogger('.'.join([__name__, self.__class__.__name__]))
+
+        self.names = []
+        self.emails = []
+        self.wish_offsets = array('L', [0])
+        self.wish_present = bytearray()
+        self.ids = {}
+
+        wishes = []
+        dont_pairs = []
+        length = 0
+        for uid, (name, email, dont_pair, wish) in enumerate(records):
+            name = sys.intern(name)
+            self.names.append(name)
+            self.emails.append(email)
+            self.ids.setdefault(name, []).append(uid)
+            dont_pairs.append(dont_pair)
+            self.wish_present.append(wish is not None)
+            if wish is not None:
+                wish = str(wish)
+                wishes.append(wish)
+                length += len(wish)
+            self.wish_offsets.append(length)
+        self.wish_text = ''.join(wishes)
+
+        self.excluded_offsets = array('L', [0])
+        self.excluded_ids = array('L')
+        ids = self.ids
+        for uid, dont_pair in enumerate(dont_pairs):
+            excluded = ids[self.names[uid]]
+            if dont_pair:
+                excluded = set(excluded)
+                for name in dont_pair:
+                    if name in ids:
+                        excluded.update(ids[name])
+                    else:
+                        self._logger.info("%s: unknown dont_pair name '%s'", self[uid], name)
+                excluded = sorted(excluded)
+            self.excluded_ids.extend(excluded)
+            self.excluded_offsets.append(len(self.excluded_ids))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, uid):
+        if not -len(self.names) <= uid < len(self.names):
+            raise IndexError("ParticipantTable index out of range")
+        return ParticipantRow(self, uid % len(self.names))
+
+    def __iter__(self):
+        for uid in range(len(self.names)):
+            yield ParticipantRow(self, uid)
+
+    def lookup(self, name):
+        '''lookup() - ids of everyone called name'''
+        return self.ids.get(name, [])
+
+    def wish_list(self, uid):
+        '''wish_list() - wish list of uid, or None'''
+        if not self.wish_present[uid]:
+            return None
+        return self.wish_text[self.wish_offsets[uid]:self.wish_offsets[uid + 1]]
+
+    def excluded(self, uid):
+        '''excluded() - sorted ids uid may not give to, itself included'''
+        return self.excluded_ids[self.excluded_offsets[uid]:self.excluded_offsets[uid + 1]]
+
+    def allowed(self, giver, reciever):
+        '''allowed() - True if id giver may give to id reciever'''
+        start = self.excluded_offsets[giver]
+        end = self.excluded_offsets[giver + 1]
+        found = bisect.bisect_left(self.excluded_ids, reciever, start, end)
+        return found == end or self.excluded_ids[found] != reciever
+
+
+#
+##############################################################################
+#
+# ParticipantRow()
+#
+class ParticipantRow(object):
+    '''
+    ParticipantRow - read-only Person-like view of one ParticipantTable row
+    '''
+    __slots__ = ('table', 'uid')
+
+    def __init__(self, table, uid):
+        super(ParticipantRow, self).__init__()
+        self.table = table
+        self.uid = uid
+
+    def __repr__(self):
+        return '"{name}" <{email}>'.format(name=self.name, email=self.email)
+
+    def __str__(self):
+        return "{name} <{email}>".format(name=self.name, email=self.email)
+
+    def __eq__(self, other):
+        return (isinstance(other, ParticipantRow) and other.table is self.table
+                and other.uid == self.uid)
+
+    def __hash__(self):
+        return hash((id(self.table), self.uid))
+
+    @property
+    def name(self):
+        '''name - from the names column'''
+        return self.table.names[self.uid]
+
+    @property
+    def email(self):
+        '''email - from the emails column'''
+        return self.table.emails[self.uid]
+
+    @property
+    def wish_list(self):
+        '''wish_list - cut out of the wish list text, or None'''
+        return self.table.wish_list(self.uid)
+
+    @property
+    def excluded(self):
+        '''excluded - ids this row may not give to, like Person.excluded'''
+        return frozenset(self.table.excluded(self.uid))
+
+    @property
+    def invalid_matches(self):
+        '''invalid_matches - known dont_pair names, like Person.invalid_matches'''
+        names = self.table.names
+        return tuple(names[uid] for uid in self.table.excluded(self.uid)
+                     if names[uid] != names[self.uid]) or None
+
+    def get_key(self):
+        '''get_key() - use name for sorting, etc'''
+        return self.name
+
+    def can_give_to(self, reciever):
+        '''can_give_to() - True unless reciever is ourself or in our exclusion list'''
+        return self.table.allowed(self.uid, reciever.uid)
+
+
+#
+##############################################################################
+#
+# popcount() - count set bits
+#
+def popcount(mask):
+    '''popcount() - number of set bits in an int bitset'''
+    return bin(mask).count('1')
+
+
+#
+##############################################################################
+#
+# iter_bits() - walk set bits
+#
+def iter_bits(mask):
+    '''iter_bits() - yield the positions of the set bits, lowest first'''
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+#
+##############################################################################
+#
+# PairingGraph()
+#
+class PairingGraph(object):
+    '''
+    PairingGraph - allowed giver -> reciever pairs as one int bitset per giver
+
+    Bit c of rows[g] is set when givers[g] may give to recievers[c], so
+    candidate filtering is a bitwise AND and counting is a popcount. The
+    whole graph is n * n bits, about 12MB for 10,000 participants. Built
+    from a ParticipantTable given as both givers and recievers, the rows
+    come straight from its exclusion runs.
+    '''
+    # random probes before pick() falls back to an exact nth-bit select
+    PROBES = 16
+
+    def __init__(self, givers, recievers):
+        super(PairingGraph, self).__init__()
+        self.givers = givers
+        self.recievers = recievers
+        self.width = len(recievers)
+        self.full = (1 << self.width) - 1
+        self._columns = {}
+
+        self.rows = []
+        if isinstance(givers, ParticipantTable) and recievers is givers:
+            # straight from the table's id runs, no per person objects
+            for uid in range(len(givers)):
+                blocked = bytearray((self.width + 7) // 8)
+                for col in givers.excluded(uid):
+                    blocked[col >> 3] |= 1 << (col & 7)
+                self.rows.append(self.full & ~int.from_bytes(blocked, 'little'))
+            return
+
+        columns = {}
+        for col, reciever in enumerate(recievers):
+            columns.setdefault(reciever.uid, []).append(col)
+
+        for giver in givers:
+            if giver.excluded is not None and None not in columns:
+                blocked = bytearray((self.width + 7) // 8)
+                for uid in giver.excluded:
+                    for col in columns.get(uid, ()):
+                        blocked[col >> 3] |= 1 << (col & 7)
+                self.rows.append(self.full & ~int.from_bytes(blocked, 'little'))
+            else:
+                row = 0
+                for col, reciever in enumerate(recievers):
+                    if giver.can_give_to(reciever):
+                        row |= 1 << col
+                self.rows.append(row)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def candidates(self, giver, available=None):
+        '''candidates() - bitset of recievers giver may still give to'''
+        if available is None:
+            return self.rows[giver]
+        return self.rows[giver] & available
+
+    def count(self, giver, available=None):
+        '''count() - number of recievers giver may still give to'''
+        return popcount(self.candidates(giver, available))
+
+    def columns(self, allowed=True):
+        '''
+        columns() - per reciever bitset of the givers that may give to it, or
+        with allowed=False of the givers that may not, built on first use
+        '''
+        if allowed not in self._columns:
+            size = (len(self.rows) + 7) // 8
+            bits = [bytearray(size) for _ in range(self.width)]
+            for giver, row in enumerate(self.rows):
+                for col in iter_bits(row if allowed else self.full & ~row):
+                    bits[col][giver >> 3] |= 1 << (giver & 7)
+            self._columns[allowed] = [int.from_bytes(column, 'little') for column in bits]
+        return self._columns[allowed]
+
+    def pick(self, mask, rng=None):
+        '''
+        pick() - uniformly random set bit of mask
+        '''
+        rng = rng or random
+        if not mask:
+            raise RuntimeError("No candidates to pick from!")
+        for _ in range(self.PROBES):
+            col = rng.randrange(self.width)
+            if mask >> col & 1:
+                return col
+        bits = bin(mask)[:1:-1]
+        col = -1
+        for _ in range(rng.randrange(popcount(mask)) + 1):
+            col = bits.find('1', col + 1)
+        return col
+
+    def augment(self, giver, match, owner, available, rng=None):
+        '''
+        augment() - find giver a reciever by moving already matched givers
+
+        Breadth-first over alternating paths: recievers giver may have are
+        taken by other givers, who may move on to other recievers, and so on
+        until one of them can take a free reciever. The shortest path wins,
+        so when one swap with a matched giver is enough that is what
+        happens. match (giver -> reciever) and owner (reciever -> giver) are
+        updated along the path.
+
+        Returns:
+            int: the free reciever that was used up, or None if no path
+            exists, in which case giver cannot be matched at all
+        '''
+        rng = rng or random
+        # reciever -> the giver that wants to take it over
+        wanted_by = {}
+        seen = 0
+        frontier = [giver]
+        while frontier:
+            rng.shuffle(frontier)
+            following = []
+            for current in frontier:
+                reach = self.rows[current] & ~seen
+                free = reach & available
+                if free:
+                    reciever = self.pick(free, rng)
+                    taken = reciever
+                    while True:
+                        previous = match.get(current)
+                        match[current] = taken
+                        owner[taken] = current
+                        if current == giver:
+                            return reciever
+                        taken = previous
+                        current = wanted_by[taken]
+                seen |= reach
+                for taken in iter_bits(reach):
+                    wanted_by[taken] = current
+                    following.append(owner[taken])
+            frontier = following
+        return None
+
+
+#
+##############################################################################
+#
+# GiverQueue()
+#
+class GiverQueue(object):
+    '''
+    GiverQueue - PairingGraph givers, fewest recievers left first
+
+    Most constrained first: pop() hands out the waiting giver with the fewest
+    candidates among the recievers not yet taken, ties broken at random.
+    Call taken() for every reciever used up so the counts stay exact. Only
+    the givers the reciever changes anything for are touched, through
+    whichever of the allowed or the blocked pairs are fewer: with sparse
+    dont_pair lists a giver only moves when a reciever it may not have goes,
+    which leaves it with more options than everyone else.
+    '''
+    def __init__(self, graph, rng=None):
+        super(GiverQueue, self).__init__()
+        self._logger = logging.getLogger('.'.join([__name__, self.__class__.__name__]))
+        self._random = rng or random
+
+        sizes = [popcount(row) for row in graph.rows]
+        allowed = 2 * sum(sizes) <= len(sizes) * graph.width
+        self._columns = graph.columns(allowed)
+        # key is the candidate count, or minus the blocked recievers still
+        # available, which orders the givers the same way
+        if allowed:
+            self._step = -1
+            self._keys = sizes
+        else:
+            self._step = 1
+            self._keys = [size - graph.width for size in sizes]
+        self._waiting = (1 << len(sizes)) - 1
+        self._heap = [(key, self._random.random(), giver) for giver, key in enumerate(self._keys)]
+        heapq.heapify(self._heap)
+        self._logger.debug("Following the %s pairs", 'allowed' if allowed else 'blocked')
+
+    def __len__(self):
+        return popcount(self._waiting)
+
+    def pop(self):
+        '''pop() - the waiting giver with the fewest candidates left'''
+        while self._heap:
+            key, _, giver = heapq.heappop(self._heap)
+            # skip givers already handed out and keys that moved since
+            if self._waiting >> giver & 1 and key == self._keys[giver]:
+                self._waiting ^= 1 << giver
+                return giver
+        raise RuntimeError("No givers left!")
+
+    def taken(self, reciever):
+        '''taken() - reciever is no longer available to the waiting givers'''
+        for giver in iter_bits(self._columns[reciever] & self._waiting):
+            self._keys[giver] += self._step
+            heapq.heappush(self._heap, (self._keys[giver], self._random.random(), giver))
+
+
+#
+##############################################################################
+#
+# Matcher()
+#
+class Matcher(object):
+    '''
+    Matcher - maximum bipartite matching of givers to recievers (Hopcroft-Karp)
+
+    Runs on a PairingGraph whose reciever columns are randomly permuted, so
+    the lowest-bit-first search still gives a random assignment. The search
+    itself is deterministic and always finds a full assignment when one exists.
+    '''
+    def __init__(self, givers, recievers, rng=None):
+        super(Matcher, self).__init__()
+        self.givers = givers
+        self.recievers = recievers
+        self._random = rng or random
+
+        self.columns = list(range(len(recievers)))
+        self._random.shuffle(self.columns)
+        self.graph = PairingGraph(givers, [recievers[col] for col in self.columns])
+
+        self.giver_match = [None] * len(givers)
+        self.reciever_match = [None] * len(recievers)
+        self._free = self.graph.full
+
+        # per phase search state, filled in by _layer() and match()
+        self._dist = []
+        self._reach = []
+        self._pending = []
+
+        self._logger = logging.getLogger('.'.join([__name__, self.__class__.__name__]))
+
+    def match(self):
+        '''
+        match() - grow the matching until no augmenting path is left
+
+        Returns:
+            int: number of matched givers
+        '''
+        order = list(range(len(self.givers)))
+        self._random.shuffle(order)
+
+        phases = 0
+        while self._layer():
+            phases += 1
+            self._pending = [None] * len(self.givers)
+            for giver in order:
+                if self.giver_match[giver] is None:
+                    self._augment(giver)
+
+        matched = len(self.givers) - self.giver_match.count(None)
+        self._logger.info("Matched %s of %s givers in %s phases", matched, len(self.givers), phases)
+        return matched
+
+    def assignment(self):
+        '''
+        assignment() - (giver index, reciever index) for everyone, or None
+        '''
+        if None in self.giver_match:
+            return None
+        return [(giver, self.columns[col]) for giver, col in enumerate(self.giver_match)]
+
+    def deadlock(self):
+        '''
+        deadlock() - smallest Hall's condition witness left by match()
+
+        Walks alternating paths from an unmatched giver and from an unmatched
+        reciever. Either walk finds k people who together have only k - 1
+        options, which is why no full assignment exists.
+
+        Returns:
+            tuple: ('giver', giver indexes, the reciever indexes they can
+            give to) or ('reciever', reciever indexes, the giver indexes that
+            can give to them), or None if everyone is matched
+        '''
+        rows = self.graph.rows
+        found = []
+
+        if None in self.giver_match:
+            frontier = [self.giver_match.index(None)]
+            stuck = frontier[:]
+            seen = 0
+            while frontier:
+                reach = 0
+                for giver in frontier:
+                    reach |= rows[giver]
+                reach &= ~seen
+                seen |= reach
+                frontier = [self.reciever_match[col] for col in iter_bits(reach)]
+                stuck.extend(frontier)
+            options = [self.columns[col] for col in iter_bits(seen)]
+            found.append(('giver', stuck, options))
+
+        if None in self.reciever_match:
+            root = self.reciever_match.index(None)
+            stuck = [root]
+            frontier = 1 << root
+            unseen = set(range(len(self.givers)))
+            options = []
+            while frontier:
+                reached = [giver for giver in unseen if rows[giver] & frontier]
+                unseen.difference_update(reached)
+                options.extend(reached)
+                frontier = 0
+                for giver in reached:
+                    frontier |= 1 << self.giver_match[giver]
+                    stuck.append(self.giver_match[giver])
+            found.append(('reciever', [self.columns[col] for col in stuck], options))
+
+        if not found:
+            return None
+        return min(found, key=lambda witness: len(witness[1]))
+
+    def _layer(self):
+        '''
+        _layer() - BFS from the free givers, True if a free reciever is reachable
+
+        Records the recievers first reached from each depth in self._reach.
+        '''
+        rows = self.graph.rows
+        self._dist = [None] * len(self.givers)
+        self._reach = []
+
+        frontier = [giver for giver, col in enumerate(self.giver_match) if col is None]
+        for giver in frontier:
+            self._dist[giver] = 0
+
+        unseen = self.graph.full
+        depth = 0
+        while frontier:
+            reach = 0
+            for giver in frontier:
+                reach |= rows[giver]
+            reach &= unseen
+            unseen &= ~reach
+            self._reach.append(reach)
+            if reach & self._free:
+                return True
+
+            depth += 1
+            frontier = []
+            for col in iter_bits(reach):
+                owner = self.reciever_match[col]
+                self._dist[owner] = depth
+                frontier.append(owner)
+        return False
+
+    def _augment(self, root):
+        '''
+        _augment() - iterative DFS along the BFS layers, flips the path if found
+        '''
+        dist = self._dist
+        pending = self._pending
+        stack = [root]
+        path = []
+        while stack:
+            giver = stack[-1]
+            if pending[giver] is None:
+                pending[giver] = self.graph.rows[giver] & self._reach[dist[giver]]
+
+            free = pending[giver] & self._free
+            if free:
+                col = (free & -free).bit_length() - 1
+                path.append(col)
+                self._free ^= 1 << col
+                for step_giver, step_col in zip(stack, path):
+                    self.giver_match[step_giver] = step_col
+                    self.reciever_match[step_col] = step_giver
+                return True
+
+            descended = False
+            cand = pending[giver]
+            while cand:
+                low = cand & -cand
+                cand ^= low
+                owner = self.reciever_match[low.bit_length() - 1]
+                if dist[owner] is not None and dist[owner] == dist[giver] + 1:
+                    pending[giver] = cand
+                    path.append(low.bit_length() - 1)
+                    stack.append(owner)
+                    descended = True
+                    break
+            if not descended:
+                # dead end for the rest of this phase
+                pending[giver] = 0
+                dist[giver] = None
+                stack.pop()
+                if path:
+                    path.pop()
+        return False
+
+
+#
+##############################################################################
+#
+# DerangementSampler()
+#
+class DerangementSampler(object):
+    '''
+    DerangementSampler - uniformly random valid assignment by rejection
+
+    Each try is a Fisher-Yates shuffle of the recievers that is thrown away as
+    soon as a finished slot is invalid. Every valid assignment is equally
+    likely, and with sparse dont_pair lists a draw succeeds in a few tries.
+    '''
+    def __init__(self, givers, recievers, max_tries=1000, rng=None):
+        super(DerangementSampler, self).__init__()
+        if len(givers) != len(recievers):
+            raise RuntimeError("Need as many recievers as givers!")
+        self.givers = givers
+        self.recievers = recievers
+        self.max_tries = max_tries
+        self.tries = 0
+        self._random = rng or random
+
+        self._logger = logging.getLogger('.'.join([__name__, self.__class__.__name__]))
+
+    def expected_tries(self):
+        '''
+        expected_tries() - rough number of tries needed for one valid draw
+
+        Each giver excludes itself plus its dont_pair list, so a random
+        reciever is invalid with probability (1 + k) / n.
+        '''
+        size = len(self.givers)
+        log_accept = 0.0
+        for giver in self.givers:
+            invalid = (1.0 + len(giver.invalid_matches or [])) / size
+            if invalid >= 1.0:
+                return float('inf')
+            log_accept += math.log1p(-invalid)
+        if -log_accept > 700:
+            return float('inf')
+        return math.exp(-log_accept)
+
+    def sample(self):
+        '''
+        sample() - (giver index, reciever index) for everyone, or None after max_tries
+        '''
+        givers = self.givers
+        recievers = self.recievers
+        randbelow = self._random.randrange
+        self.tries = 0
+        while self.tries < self.max_tries:
+            self.tries += 1
+            order = list(range(len(recievers)))
+            for slot in range(len(order) - 1, -1, -1):
+                pick = randbelow(slot + 1)
+                order[slot], order[pick] = order[pick], order[slot]
+                if not givers[slot].can_give_to(recievers[order[slot]]):
+                    break
+            else:
+                self._logger.info("Valid draw after %s tries", self.tries)
+                return list(enumerate(order))
+        self._logger.info("No valid draw in %s tries", self.tries)
+        return None
+
+#
+##############################################################################
+#
+# NumpyPairing()
+#
+class NumpyPairing(object):
+    '''
+    NumpyPairing - vectorized pairing for very large rosters (needs numpy)
+
+    The forbidden giver -> reciever pairs are kept as one sorted int64 key
+    per pair (giver * n + reciever), so memory grows with the dont_pair
+    lists instead of n * n. A candidate permutation is checked against all
+    of them with one gather and compare. sample() draws whole permutations
+    until one is valid, which is uniform over valid assignments. repair()
+    instead fixes the few conflicts of one draw with batches of random
+    swaps, which is quick even when rejection is hopeless but only close
+    to uniform.
+    '''
+    def __init__(self, givers, recievers, seed=None):
+        super(NumpyPairing, self).__init__()
+        if None in [numpy]:
+            raise RuntimeError("NumpyPairing needs numpy installed!")
+        if len(givers) != len(recievers):
+            raise RuntimeError("Need as many recievers as givers!")
+        self.size = len(givers)
+        self.tries = 0
+        self.rounds = 0
+        self._random = numpy.random.default_rng(seed)
+        self._logger = logging.getLogger('.'.join([__name__, self.__class__.__name__]))
+
+        if isinstance(givers, ParticipantTable) and recievers is givers:
+            offsets = numpy.asarray(givers.excluded_offsets, dtype=numpy.int64)
+            cols = numpy.asarray(givers.excluded_ids, dtype=numpy.int64)
+        else:
+            columns = {}
+            for col, reciever in enumerate(recievers):
+                columns.setdefault(reciever.uid, []).append(col)
+            if None in columns:
+                raise RuntimeError("Compile the participants with ExclusionIndex first!")
+            counts = []
+            blocked = []
+            for giver in givers:
+                row = sorted(col for uid in giver.excluded for col in columns.get(uid, ()))
+                counts.append(len(row))
+                blocked.extend(row)
+            offsets = numpy.concatenate(([0], numpy.cumsum(counts, dtype=numpy.int64)))
+            cols = numpy.asarray(blocked, dtype=numpy.int64)
+
+        self.counts = numpy.diff(offsets)
+        self.rows = numpy.repeat(numpy.arange(self.size, dtype=numpy.int64), self.counts)
+        self.cols = cols
+        # sorted, as rows ascend and every row's columns are sorted
+        self.keys = self.rows * self.size + self.cols
+
+    def expected_tries(self):
+        '''expected_tries() - rough number of sample() tries for one valid draw'''
+        invalid = self.counts / float(self.size)
+        if self.size and invalid.max() >= 1.0:
+            return float('inf')
+        log_accept = float(numpy.log1p(-invalid).sum())
+        if -log_accept > 700:
+            return float('inf')
+        return math.exp(-log_accept)
+
+    def allowed(self, givers, recievers):
+        '''allowed() - bool array, True where givers[i] may give to recievers[i]'''
+        wanted = givers * self.size + recievers
+        if not self.keys.size:
+            return numpy.ones(wanted.shape, dtype=bool)
+        found = numpy.minimum(numpy.searchsorted(self.keys, wanted), self.keys.size - 1)
+        return self.keys[found] != wanted
+
+    def conflicts(self, order):
+        '''conflicts() - sorted givers that order assigns to a forbidden reciever'''
+        return numpy.unique(self.rows[order[self.rows] == self.cols])
+
+    def sample(self, max_tries=1000):
+        '''
+        sample() - uniformly random valid order by rejection
+
+        Returns:
+            numpy.ndarray: reciever index for every giver, or None after max_tries
+        '''
+        self.tries = 0
+        while self.tries < max_tries:
+            self.tries += 1
+            order = self._random.permutation(self.size)
+            if not self.conflicts(order).size:
+                self._logger.info("Valid draw after %s tries", self.tries)
+                return order
+        self._logger.info("No valid draw in %s tries", self.tries)
+        return None
+
+    def repair(self, order=None, max_rounds=1000):
+        '''
+        repair() - swap recievers until order is valid
+
+        Each round pairs every conflicting giver with a random partner and
+        swaps their recievers where both end up allowed. Swaps in a round
+        touch disjoint givers, and never break a valid slot, so conflicts
+        only go down.
+
+        Returns:
+            numpy.ndarray: reciever index for every giver, or None after max_rounds
+        '''
+        if order is None:
+            order = self._random.permutation(self.size)
+        order = order.copy()
+        self.rounds = 0
+        while self.rounds < max_rounds:
+            bad = self.conflicts(order)
+            if not bad.size:
+                self._logger.info("Repaired in %s rounds", self.rounds)
+                return order
+            self.rounds += 1
+            partners = self._random.integers(0, self.size, size=bad.size)
+            touched = numpy.bincount(numpy.concatenate((bad, partners)), minlength=self.size)
+            keep = (touched[bad] == 1) & (touched[partners] == 1)
+            bad, partners = bad[keep], partners[keep]
+            good = self.allowed(bad, order[partners]) & self.allowed(partners, order[bad])
+            bad, partners = bad[good], partners[good]
+            order[bad], order[partners] = order[partners], order[bad]
+        self._logger.info("Still %s conflicts after %s rounds", self.conflicts(order).size,
+                          self.rounds)
+        return None
+
+
+#
+##############################################################################
+#
+# MessageTemplate()
+#
+class MessageTemplate(object):
+    '''
+    MessageTemplate - a str.format template split once into literals and slots
+
+    render() fills the named slots of a prebuilt segment list and joins it,
+    instead of parsing the template again for every Pair. Templates using
+    positional fields, attribute access, conversions or format specs keep
+    using str.format.
+    '''
+    def __init__(self, template):
+        super(MessageTemplate, self).__init__()
+        self.template = template
+        self.segments = []
+        self.slots = []
+        self.simple = True
+
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            if literal:
+                self.segments.append(literal)
+            if None not in [field]:
+                if spec or conversion or not field.isidentifier():
+                    self.simple = False
+                self.slots.append((len(self.segments), field))
+                self.segments.append(None)
+
+    def __str__(self):
+        return self.template
+
+    def render(self, **fields):
+        '''render() - the template with fields filled in, like str.format'''
+        if not self.simple:
+            return self.template.format(**fields)
+        segments = self.segments[:]
+        for position, field in self.slots:
+            segments[position] = str(fields[field])
+        return ''.join(segments)
+
+
+#
+##############################################################################
+#
+# MimeTemplate()
+#
+class MimeTemplate(object):
+    '''
+    MimeTemplate - UTF-8 text/plain email with its fixed headers rendered once
+
+    Produces the same text as building a MIMEText and calling as_string(),
+    but the MIME headers and From are rendered up front. The per message
+    headers skip the email package when they are plain ASCII.
+    '''
+    _POLICY = compat32.clone(max_line_length=0)
+
+    def __init__(self, sender):
+        super(MimeTemplate, self).__init__()
+        prototype = MIMEText(b'', _charset='utf-8')
+        self.prefix = ''.join(self.header(name, value) for name, value in prototype.items())
+        self.sender = self.header('From', sender)
+
+    @classmethod
+    def header(cls, name, value):
+        '''header() - one rendered header line, as as_string() would write it'''
+        if value.isascii() and '\n' not in value and '\r' not in value:
+            return '{0}: {1}\n'.format(name, value)
+        return cls._POLICY.fold(name, value)
+
+    def render(self, date, message_id, recipient, subject, body):
+        '''render() - the full message text'''
+        return ''.join([
+            self.prefix,
+            self.header('Date', date),
+            self.header('Message-Id', message_id),
+            self.sender,
+            self.header('To', recipient),
+            self.header('Subject', subject),
+            '\n',
+            base64mime.body_encode(body.encode('utf-8')),
+        ])
+
+
+#
+##############################################################################
+#
+# MessageFactory()
+#
+class MessageFactory(object):
+    '''
+    MessageFactory - builds every notification email of a run
+
+    Everything that is the same for each message is worked out once: the
+    compiled SUBJECT and MESSAGE templates, the MIME and From headers, the
+    hostname and the time zone. The Date header is cached per second.
+    Message-Ids are a per-run prefix plus a counter instead of a fresh
+    time.time() + random.random() string.
+    '''
+    # Sun, 21 Dec 2008 06:25:23 EST
+    DATE_FORMAT = '%a, %d %b %Y %T %Z'
+
+    def __init__(self, sender, subject, message, time_zone, hostname=None, clock=time.time):
+        super(MessageFactory, self).__init__()
+        self.sender = sender
+        self.subject = MessageTemplate(subject)
+        self.message = MessageTemplate(message)
+        self.time_zone = time_zone
+        self.hostname = hostname or socket.gethostname()
+        self.mime = MimeTemplate('"{name}" <{email}>'.format(name="Secret Santa", email=sender))
+
+        self._clock = clock
+        self._second = None
+        self._date = None
+        self._counter = itertools.count(1)
+        self._id_prefix = '{0}.{1}.{2:08x}'.format(int(clock()), os.getpid(),
+                                                     random.getrandbits(32))
+
+    def date(self):
+        '''date() - Date header value, recomputed at most once a second'''
+        second = int(self._clock())
+        if second != self._second:
+            now = self.time_zone.localize(datetime.datetime.fromtimestamp(second))
+            self._date = now.strftime(self.DATE_FORMAT)
+            self._second = second
+        return self._date
+
+    def message_id(self):
+        '''message_id() - unique Message-Id header value'''
+        return '<{0}.{1}@{2}>'.format(self._id_prefix, next(self._counter), self.hostname)
+
+    def build(self, pair):
+        '''
+        build() - the notification for one Pair
+
+        Returns:
+            str: full message text, ready for sendmail()
+        '''
+        return self.mime.render(
+            self.date(),
+            self.message_id(),
+            '"{name}" <{email}>'.format(name=pair.giver.name, email=pair.giver.email),
+            self.subject.render(santa=pair.giver.name, santee=pair.reciever.name),
+            pair.generate_email(message=self.message),
+        )
+
+
+#
+##############################################################################
+#
+# RateLimiter()
+#
+class RateLimiter(object):
+    '''
+    RateLimiter - thread safe token bucket with an adaptive rate
+
+    reserve() books the next token and returns how long to sleep for it, so
+    it works from threads and coroutines alike. throttled() halves the rate
+    when the relay pushes back, at most once per cooldown seconds so a burst
+    of rejections counts once, and succeeded() wins it back a little at a
+    time (additive increase, multiplicative decrease).
+    '''
+    def __init__(self, rate, burst=None, min_rate=None, cooldown=1.0, clock=time.monotonic):
+        super(RateLimiter, self).__init__()
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.min_rate = float(min_rate or self.max_rate / 64)
+        self.burst = float(burst or max(1.0, self.max_rate))
+        self.cooldown = cooldown
+        self._clock = clock
+        self._tokens = self.burst
+        self._stamp = clock()
+        self._slowed = None
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        '''reserve() - take one token, returns the seconds to wait before using it'''
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        '''acquire() - block until a token is available'''
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    def throttled(self):
+        '''throttled() - the relay said slow down, halve the rate'''
+        with self._lock:
+            now = self._clock()
+            if None in [self._slowed] or now - self._slowed >= self.cooldown:
+                self._slowed = now
+                self.rate = max(self.min_rate, self.rate / 2)
+                self._tokens = min(self._tokens, 0.0)
+            return self.rate
+
+    def succeeded(self):
+        '''succeeded() - a message went through, creep back toward max_rate'''
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 32)
+
+
+#
+##############################################################################
+#
+# SmtpSender()
+#
+class SmtpSender(object):
+    '''
+    SmtpSender - connection handling shared by the SMTP delivery engines
+
+    Subclasses implement start(), submit() and close(). sent, retries and
+    failures are filled in as messages go out. Transient 4xx replies are
+    retried up to max_retries times with exponential backoff, and slow the
+    optional RateLimiter down. A refused login stops every delivery: the
+    remaining messages are failed and close() raises. No socket operation
+    blocks for more than timeout seconds. An optional StageTimer gets the
+    smtp_connect, smtp_login and smtp_send times and the messages_sent,
+    smtp_retries and smtp_failures counts.
+    '''
+    # transient replies that also mean the server is dropping the connection
+    CLOSING_CODES = (421,)
+    # errors no other message or retry can get past
+    FATAL_ERRORS = (smtplib.SMTPAuthenticationError,)
+
+    def __init__(self, host, port, username, password, size=1, max_per_connection=100,
+                 limiter=None, max_retries=0, backoff=1.0, on_result=None, starttls=True,
+                 timer=None, timeout=30):
+        super(SmtpSender, self).__init__()
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.size = max(1, size)
+        self.max_per_connection = max(1, max_per_connection)
+        self.limiter = limiter
+        self.max_retries = max(0, max_retries)
+        self.backoff = backoff
+        # seconds any one socket operation may block
+        self.timeout = timeout
+        # called as on_result(label, error), error is None once delivered
+        self.on_result = on_result
+        self.timer = timer
+
+        self.sent = 0
+        self.retries = 0
+        self.failures = []
+        # the FATAL_ERRORS error that stopped delivery, if any
+        self.aborted = None
+
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger('.'.join([__name__, self.__class__.__name__]))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        '''start() - get ready to accept messages'''
+        raise NotImplementedError
+
+    def submit(self, sender, recipients, message, label=None):
+        '''submit() - hand over one message for delivery'''
+        raise NotImplementedError
+
+    def close(self):
+        '''close() - deliver everything submitted and hang up'''
+        raise NotImplementedError
+
+    def _connect(self):
+        '''_connect() - open one authenticated (STARTTLS unless disabled) connection'''
+        self._logger.info("Connecting to: '%s'", self.host)
+        with self._stage('smtp_connect'):
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            # server.set_debuglevel(True)
+            if self.starttls:
+                server.starttls()
+        with self._stage('smtp_login'):
+            server.login(self.username, self.password)
+        return server
+
+    def _sendmail(self, server, sender, recipients, message):
+        '''_sendmail() - server.sendmail(), timed as smtp_send'''
+        with self._stage('smtp_send'):
+            return server.sendmail(sender, recipients, message)
+
+    def _stage(self, name):
+        '''_stage() - timer.stage(name), or a no-op without a timer'''
+        if None in [self.timer]:
+            return contextlib.nullcontext()
+        return self.timer.stage(name)
+
+    def _count(self, name):
+        '''_count() - bump counter name on the timer, if there is one'''
+        if None not in [self.timer]:
+            self.timer.count(name)
+
+    def _hang_up(self, server):
+        '''_hang_up() - quit a connection, ignoring a dead socket'''
+        if None not in [server]:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
+
+    @staticmethod
+    def _reply_codes(err):
+        '''_reply_codes() - SMTP reply codes carried by an smtplib exception'''
+        if isinstance(err, smtplib.SMTPRecipientsRefused):
+            return [code for code, _ in err.recipients.values()]
+        if isinstance(err, smtplib.SMTPResponseException):
+            return [err.smtp_code]
+        return []
+
+    def _classify(self, err):
+        '''
+        _classify() - how to react to a failed send
+
+        Returns:
+            tuple: (keep the connection, worth retrying)
+        '''
+        codes = self._reply_codes(err)
+        transient = bool(codes) and all(400 <= code < 500 for code in codes)
+        refused = isinstance(err, (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                                   smtplib.SMTPDataError))
+        keep = refused and not any(code in self.CLOSING_CODES for code in codes)
+        return keep, transient
+
+    def _retry_delay(self, label, err, attempt):
+        '''_retry_delay() - note a transient failure, returns the seconds to back off'''
+        with self._lock:
+            self.retries += 1
+        self._count('smtp_retries')
+        if None not in [self.limiter]:
+            rate = self.limiter.throttled()
+            self._logger.warning("Relay throttled %s: '%s', rate now %.2f/s", label, err, rate)
+        else:
+            self._logger.warning("Relay throttled %s: '%s'", label, err)
+        return self.backoff * (2 ** attempt) * (0.5 + random.random())
+
+    def _succeed(self, label, result):
+        '''_succeed() - record a delivered message'''
+        self._logger.debug("Result: '%s'", result)
+        self._logger.info("Emailed %s", label)
+        if None not in [self.limiter]:
+            self.limiter.succeeded()
+        with self._lock:
+            self.sent += 1
+        self._count('messages_sent')
+        if None not in [self.on_result]:
+            self.on_result(label, None)
+
+    def _fail(self, label, err):
+        '''_fail() - record a message that could not be sent'''
+        self._logger.error("Failed to email %s: '%s'", label, err)
+        with self._lock:
+            self.failures.append((label, err))
+        self._count('smtp_failures')
+        if None not in [self.on_result]:
+            self.on_result(label, err)
+
+    def _abort(self, label, err):
+        '''_abort() - fail label and stop delivering anything else'''
+        with self._lock:
+            first = None in [self.aborted]
+            if first:
+                self.aborted = err
+        if first:
+            self._logger.critical("Giving up on every message: '%s'", err)
+        self._fail(label, err)
+
+    def _check_aborted(self):
+        '''_check_aborted() - raise if delivery was stopped by _abort()'''
+        if None not in [self.aborted]:
+            raise RuntimeError("Stopped sending after '{0}', {1} messages not sent".format(
+                self.aborted, len(self.failures))) from self.aborted
+
+
+#
+##############################################################################
+#
+# SmtpPool()
+#
+class SmtpPool(SmtpSender):
+    '''
+    SmtpPool - deliver messages over a pool of authenticated SMTP connections
+
+    Each worker thread owns one STARTTLS connection and reconnects after
+    max_per_connection messages, so a provider's per-connection cap is never
+    hit. submit() blocks while the bounded queue is full, unless no worker
+    is left to drain it.
+    '''
+    # seconds between checks on the workers while the queue is full
+    POLL = 0.5
+
+    def __init__(self, host, port, username, password, queue_size=None, **kwargs):
+        super(SmtpPool, self).__init__(host, port, username, password, **kwargs)
+        self._queue = queue.Queue(maxsize=queue_size or self.size * 4)
+        self._threads = []
+
+    def start(self):
+        '''start() - launch the worker threads'''
+        for number in range(self.size):
+            thread = threading.Thread(target=self._work, name='smtp-{0}'.format(number))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, sender, recipients, message, label=None):
+        '''submit() - queue one message, blocks while the queue is full'''
+        label = label or recipients
+        if None not in [self.aborted]:
+            self._fail(label, self.aborted)
+        elif not self._put((sender, recipients, message, label)):
+            self._fail(label, "no SMTP worker left to send it")
+
+    def close(self):
+        '''close() - wait for the queue to drain and hang up every connection'''
+        for _ in self._threads:
+            if not self._put(None):
+                break
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        # anything a dead worker left behind
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if None not in [item]:
+                self._fail(item[3], "no SMTP worker left to send it")
+        self._logger.info("Sent %s messages, %s failed", self.sent, len(self.failures))
+        self._check_aborted()
+
+    def _put(self, item):
+        '''_put() - queue item, False instead of waiting when every worker is gone'''
+        while True:
+            try:
+                self._queue.put(item, timeout=self.POLL)
+                return True
+            except queue.Full:
+                if not any(thread.is_alive() for thread in self._threads):
+                    return False
+
+    def _work(self):
+        '''_work() - worker thread: send queued messages until the sentinel'''
+        server = None
+        count = 0
+        while True:
+            item = self._queue.get()
+            if None in [item]:
+                break
+            sender, recipients, message, label = item
+            for attempt in range(self.max_retries + 1):
+                if None not in [self.aborted]:
+                    self._fail(label, self.aborted)
+                    break
+                if None not in [self.limiter]:
+                    self.limiter.acquire()
+                try:
+                    if None in [server] or count >= self.max_per_connection:
+                        self._hang_up(server)
+                        server = None
+                        server = self._connect()
+                        count = 0
+                    count += 1
+                    result = self._sendmail(server, sender, recipients, message)
+                except self.FATAL_ERRORS as err:
+                    self._hang_up(server)
+                    server = None
+                    self._abort(label, err)
+                    break
+                except (smtplib.SMTPException, OSError) as err:
+                    keep, transient = self._classify(err)
+                    if not keep:
+                        self._hang_up(server)
+                        server = None
+                    if transient and attempt < self.max_retries:
+                        time.sleep(self._retry_delay(label, err, attempt))
+                        continue
+                    self._fail(label, err)
+                    break
+                # pylint: disable=broad-except
+                except Exception as err:
+                    # e.g. an address smtplib cannot encode, don't lose the worker
+                    self._hang_up(server)
+                    server = None
+                    self._fail(label, err)
+                    break
+                else:
+                    self._succeed(label, result)
+                    break
+        self._hang_up(server)
+
+
+#
+##############################################################################
+#
+# AsyncSmtpSender()
+#
+class AsyncSmtpSender(SmtpSender):
+    '''
+    AsyncSmtpSender - pipeline messages over concurrent SMTP sessions with asyncio
+
+    An asyncio.Semaphore keeps at most size sessions busy at once. Idle
+    connections are reused until max_per_connection, and every message is
+    given timeout seconds. smtplib is blocking, so each session's calls run
+    on a thread of its own executor.
+    '''
+    def __init__(self, host, port, username, password, **kwargs):
+        kwargs.setdefault('size', 8)
+        super(AsyncSmtpSender, self).__init__(host, port, username, password, **kwargs)
+        self._messages = []
+
+    def start(self):
+        '''start() - nothing to do until close() runs the event loop'''
+        self._messages = []
+
+    def submit(self, sender, recipients, message, label=None):
+        '''submit() - collect one message for close() to send'''
+        self._messages.append((sender, recipients, message, label or recipients))
+
+    def close(self):
+        '''close() - run the event loop until every message is sent or failed'''
+        messages, self._messages = self._messages, []
+        if messages:
+            asyncio.run(self._send_all(messages))
+        self._logger.info("Sent %s messages, %s failed", self.sent, len(self.failures))
+        self._check_aborted()
+
+    async def _send_all(self, messages):
+        '''_send_all() - one task per message, limited by the semaphore'''
+        loop = asyncio.get_event_loop()
+        executor = ThreadPoolExecutor(max_workers=self.size)
+        semaphore = asyncio.Semaphore(self.size)
+        idle = []
+
+        async def deliver(item):
+            sender, recipients, message, label = item
+            for attempt in range(self.max_retries + 1):
+                async with semaphore:
+                    if None not in [self.aborted]:
+                        self._fail(label, self.aborted)
+                        return
+                    if None not in [self.limiter]:
+                        # inside the semaphore, so at most size tokens are booked ahead
+                        await asyncio.sleep(self.limiter.reserve())
+                    server, count = idle.pop() if idle else (None, 0)
+                    connecting = None
+                    try:
+                        if None in [server] or count >= self.max_per_connection:
+                            await loop.run_in_executor(executor, self._hang_up, server)
+                            server = None
+                            connecting = executor.submit(self._connect)
+                            server = await asyncio.wait_for(asyncio.wrap_future(connecting),
+                                                            self.timeout)
+                            count = 0
+                        count += 1
+                        result = await asyncio.wait_for(
+                            loop.run_in_executor(executor, self._sendmail, server, sender,
+                                                 recipients, message),
+                            self.timeout)
+                    except asyncio.TimeoutError:
+                        self._fail(label, "timed out after {0}s".format(self.timeout))
+                        if None not in [server]:
+                            # unblocks the executor thread still stuck on this socket
+                            server.close()
+                        elif None not in [connecting]:
+                            connecting.add_done_callback(self._abandoned)
+                        return
+                    except self.FATAL_ERRORS as err:
+                        await loop.run_in_executor(executor, self._hang_up, server)
+                        self._abort(label, err)
+                        return
+                    except (smtplib.SMTPException, OSError) as err:
+                        keep, transient = self._classify(err)
+                        if keep:
+                            idle.append((server, count))
+                        else:
+                            await loop.run_in_executor(executor, self._hang_up, server)
+                        if not transient or attempt >= self.max_retries:
+                            self._fail(label, err)
+                            return
+                        delay = self._retry_delay(label, err, attempt)
+                    # pylint: disable=broad-except
+                    except Exception as err:
+                        # e.g. an address smtplib cannot encode, don't stop the others
+                        await loop.run_in_executor(executor, self._hang_up, server)
+                        self._fail(label, err)
+                        return
+                    else:
+                        self._succeed(label, result)
+                        idle.append((server, count))
+                        return
+                # back off outside the semaphore so other sessions keep going
+                await asyncio.sleep(delay)
+
+        try:
+            await asyncio.gather(*[deliver(item) for item in messages])
+        finally:
+            for server, _ in idle:
+                await loop.run_in_executor(executor, self._hang_up, server)
+            executor.shutdown(wait=False)
+
+    def _abandoned(self, future):
+        '''_abandoned() - hang up a connection that was given up on while opening'''
+        if not future.cancelled() and None in [future.exception()]:
+            self._hang_up(future.result())
+
+
+#
+##############################################################################
+#
+# SendJournal()
+#
+class SendJournal(object):
+    '''
+    SendJournal - append-only record of one send run, so it can be resumed
+
+    The first line holds the pairing, then one JSON line per delivered or
+    failed message. Status lines are fsync'd in batches, so a crash loses at
+    most the last batch and those few messages are sent again on resume.
+    The file is only opened for appending once something is recorded.
+    '''
+    def __init__(self, path, run_id, pairs, sent=None, batch=50):
+        super(SendJournal, self).__init__()
+        self.path = path
+        self.run_id = run_id
+        self.pairs = pairs
+        self.sent = set(sent or [])
+        self.batch = max(1, batch)
+
+        self._unsynced = 0
+        self._lock = threading.Lock()
+        self._handle = None
+        self._logger = logging.getLogger('.'.join([__name__, self.__class__.__name__]))
+
+    @staticmethod
+    def journal_path(directory, run_id):
+        '''journal_path() - where the journal for run_id lives'''
+        return os.path.join(directory, '{0}.journal'.format(run_id))
+
+    @classmethod
+    def create(cls, directory, run_id, pairs, batch=50):
+        '''
+        create() - start a journal for a new run
+
+        pairs is a list of dicts describing each Pair. It is synced to disk
+        before create() returns, so no message can go out unrecorded.
+        '''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = cls.journal_path(directory, run_id)
+        if os.path.exists(path):
+            raise RuntimeError("Journal '{0}' already exists!".format(path))
+
+        journal = cls(path, run_id, pairs, batch=batch)
+        journal._write({'type': 'pairs', 'run': run_id, 'pairs': pairs})
+        journal.sync()
+        return journal
+
+    @classmethod
+    def load(cls, directory, run_id, batch=50):
+        '''
+        load() - reopen the journal of an earlier run to append to it
+        '''
+        path = cls.journal_path(directory, run_id)
+        if not os.path.exists(path):
+            raise RuntimeError("No journal for run '{0}' in '{1}'!".format(run_id, directory))
+
+        logger = logging.getLogger('.'.join([__name__, cls.__name__]))
+        pairs = None
+        sent = set()
+        # bytes up to the end of the last complete line, and whether the
+        # unterminated rest (if any) still held a whole record
+        complete = 0
+        whole_tail = False
+        with open(path, 'rb') as handle:
+            for number, line in enumerate(handle, 1):
+                terminated = line.endswith(b"\n")
+                if terminated:
+                    complete += len(line)
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    logger.warning("Skipping damaged line %s of '%s'", number, path)
+                    continue
+                whole_tail = not terminated
+                if record['type'] == 'pairs':
+                    pairs = record['pairs']
+                elif record['type'] == 'sent':
+                    sent.add(record['pair'])
+                elif record['type'] == 'failed':
+                    sent.discard(record['pair'])
+
+        if None in [pairs]:
+            raise RuntimeError("Journal '{0}' has no pairing!".format(path))
+
+        # a crash can leave the last line unfinished, make sure the next
+        # record starts on a line of its own
+        if complete < os.path.getsize(path):
+            with open(path, 'r+b') as handle:
+                if whole_tail:
+                    handle.seek(0, os.SEEK_END)
+                    handle.write(b"\n")
+                else:
+                    logger.warning("Dropping the unfinished last line of '%s'", path)
+                    handle.truncate(complete)
+        return cls(path, run_id, pairs, sent=sent, batch=batch)
+
+    def pending(self):
+        '''pending() - indexes into pairs that have not been delivered yet'''
+        return [idx for idx in range(len(self.pairs)) if idx not in self.sent]
+
+    def record(self, idx, error=None):
+        '''record() - note the outcome of the message for pairs[idx]'''
+        with self._lock:
+            if None in [error]:
+                self.sent.add(idx)
+                self._write({'type': 'sent', 'pair': idx})
+            else:
+                self._write({'type': 'failed', 'pair': idx, 'error': str(error)})
+            self._unsynced += 1
+            if self._unsynced >= self.batch:
+                self._sync()
+
+    def sync(self):
+        '''sync() - flush and fsync everything recorded so far'''
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        '''close() - sync and close the journal file'''
+        with self._lock:
+            if None not in [self._handle] and not self._handle.closed:
+                self._sync()
+                self._handle.close()
+        self._logger.info("Journal '%s': %s of %s delivered", self.path, len(self.sent), len(self.pairs))
+
+    def _write(self, record):
+        '''_write() - append one JSON line'''
+        if None in [self._handle]:
+            self._handle = open(self.path, 'a', encoding='utf-8')
+        self._handle.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def _sync(self):
+        '''_sync() - flush and fsync, caller holds the lock'''
+        if None in [self._handle]:
+            return
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+        self._unsynced = 0
+
+
+#
+##############################################################################
+#
+# PairingSnapshot()
+#
+class PairingSnapshot(object):
+    '''
+    PairingSnapshot - a pairing saved in a compact, versioned binary file
+
+    Layout, all little-endian:
+
+        header    magic 'SSPR', u16 version, u16 reserved, u32 count, u32 slots
+        offsets   u32 * count, file offset of each record
+        slots     u32 * slots, open addressing table on crc32(giver name),
+                  record number + 1 or 0 when empty
+        records   giver, giver_email, reciever, reciever_email as u16 length
+                  prefixed UTF-8
+
+    The file is mmap'd, so lookup() reads only the slot, offset and record it
+    needs instead of loading the whole pairing.
+    '''
+    MAGIC = b'SSPR'
+    VERSION = 1
+    FIELDS = ('giver', 'giver_email', 'reciever', 'reciever_email')
+
+    _HEADER = struct.Struct('<4sHHII')
+    _U16 = struct.Struct('<H')
+    _U32 = struct.Struct('<I')
+
+    def __init__(self, path):
+        super(PairingSnapshot, self).__init__()
+        self.path = path
+        with open(path, 'rb') as handle:
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, self.count, self.slots = self._HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC:
+            self.close()
+            raise RuntimeError("'{0}' is not a pairing snapshot!".format(path))
+        if version != self.VERSION:
+            self.close()
+            raise RuntimeError("Snapshot '{0}' is version {1}, expected {2}!".format(
+                path, version, self.VERSION))
+
+        self._offsets = self._HEADER.size
+        self._table = self._offsets + self.count * self._U32.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self.count:
+            raise IndexError(idx)
+        offset = self._U32.unpack_from(self._map, self._offsets + idx * self._U32.size)[0]
+        record = {}
+        for field in self.FIELDS:
+            size = self._U16.unpack_from(self._map, offset)[0]
+            offset += self._U16.size
+            record[field] = self._map[offset:offset + size].decode('utf-8')
+            offset += size
+        return record
+
+    def close(self):
+        '''close() - release the mmap'''
+        self._map.close()
+
+    def lookup(self, giver):
+        '''
+        lookup() - the record for the named giver, or None
+
+        One hash, then usually a single slot and record read.
+        '''
+        mask = self.slots - 1
+        slot = zlib.crc32(giver.encode('utf-8')) & mask
+        while True:
+            entry = self._U32.unpack_from(self._map, self._table + slot * self._U32.size)[0]
+            if not entry:
+                return None
+            record = self[entry - 1]
+            if record['giver'] == giver:
+                return record
+            slot = (slot + 1) & mask
+
+    @classmethod
+    def write(cls, path, records):
+        '''
+        write() - save records (dicts with FIELDS) to path, atomically
+        '''
+        slots = 1
+        while slots < 2 * max(1, len(records)):
+            slots <<= 1
+
+        table = [0] * slots
+        blobs = []
+        for idx, record in enumerate(records):
+            blob = b''
+            for field in cls.FIELDS:
+                data = record[field].encode('utf-8')
+                if len(data) > 0xffff:
+                    raise RuntimeError("'{0}' is too long for a snapshot!".format(field))
+                blob += cls._U16.pack(len(data)) + data
+            blobs.append(blob)
+
+            slot = zlib.crc32(record['giver'].encode('utf-8')) & (slots - 1)
+            while table[slot]:
+                slot = (slot + 1) & (slots - 1)
+            table[slot] = idx + 1
+
+        offset = cls._HEADER.size + (len(records) + slots) * cls._U32.size
+        offsets = []
+        for blob in blobs:
+            offsets.append(offset)
+            offset += len(blob)
+
+        temp = '{0}.tmp'.format(path)
+        with open(temp, 'wb') as handle:
+            handle.write(cls._HEADER.pack(cls.MAGIC, cls.VERSION, 0, len(records), slots))
+            handle.write(struct.pack('<{0}I'.format(len(offsets)), *offsets))
+            handle.write(struct.pack('<{0}I'.format(slots), *table))
+            handle.write(b''.join(blobs))
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp, path)
+
+
+#
+##############################################################################
+#
+# ConfigCache()
+#
+class ConfigCache(object):
+    '''
+    ConfigCache - pickled result of reading the config, reused until it changes
+
+    The cache records the size, mtime and SHA-256 of every source file it
+    was built from. load() trusts a file whose size and mtime still match,
+    and hashes it otherwise, so a touched but unchanged file is still a
+    hit. The pickle holds the whole config, password included, and is
+    written readable by its owner only. Only load caches you wrote: a
+    pickle can run code.
+    '''
+    VERSION = 1
+
+    def __init__(self, path):
+        super(ConfigCache, self).__init__()
+        self.path = path
+        self._logger = logging.getLogger('.'.join([__name__, self.__class__.__name__]))
+
+    @staticmethod
+    def digest(path):
+        '''digest() - SHA-256 hex digest of the file at path'''
+        sha = hashlib.sha256()
+        with open(path, 'rb') as handle:
+            for block in iter(lambda: handle.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    @classmethod
+    def fingerprint(cls, path):
+        '''
+        fingerprint() - what load() compares a source file by
+
+        Returns:
+            tuple: (path, size, mtime in ns, SHA-256 hex digest)
+        '''
+        info = os.stat(path)
+        return (str(path), info.st_size, info.st_mtime_ns, cls.digest(path))
+
+    def load(self):
+        '''
+        load() - the cached payload, if every source file is unchanged
+
+        Returns:
+            object: what save() stored, or None on a miss
+        '''
+        try:
+            with open(self.path, 'rb') as handle:
+                entry = pickle.load(handle)
+        except FileNotFoundError:
+            return None
+        # pylint: disable=broad-except
+        except Exception as err:
+            self._logger.info("Ignoring unreadable cache '%s': '%s'", self.path, err)
+            return None
+
+        if not isinstance(entry, dict) or entry.get('version') != self.VERSION:
+            return None
+        for path, size, mtime, digest in entry['sources']:
+            try:
+                info = os.stat(path)
+                if (info.st_size, info.st_mtime_ns) == (size, mtime):
+                    continue
+                if info.st_size == size and self.digest(path) == digest:
+                    continue
+            except OSError:
+                pass
+            self._logger.info("'%s' changed since '%s' was written", path, self.path)
+            return None
+        return entry['payload']
+
+    def save(self, sources, payload):
+        '''save() - store payload as built from sources, fingerprint() tuples of its files'''
+        entry = {
+            'version': self.VERSION,
+            'sources': list(sources),
+            'payload': payload,
+        }
+        temp = '{0}.tmp'.format(self.path)
+        handle = os.fdopen(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb')
+        with handle:
+            pickle.dump(entry, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, self.path)
+        self._logger.info("Cached config in '%s'", self.path)
+
+
+#
+##############################################################################
+#
+# StageTimer()
+#
+class StageTimer(object):
+    '''
+    StageTimer - wall time spent in each named stage of a run
+
+    Stages are timed with the stage() context manager or add(). A stage
+    that runs many times, or on several threads at once like the SMTP
+    sends, keeps its call count, total and slowest call. count() keeps
+    plain event counters such as retries alongside.
+    '''
+    def __init__(self, clock=time.perf_counter):
+        super(StageTimer, self).__init__()
+        self.clock = clock
+        # name -> [calls, total seconds, slowest call]
+        self.stages = {}
+        self.counters = {}
+        self.started = clock()
+
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger('.'.join([__name__, self.__class__.__name__]))
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''stage() - time the with block as one call of stage name'''
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(name, self.clock() - start)
+
+    def add(self, name, seconds):
+        '''add() - record one call of stage name that took seconds'''
+        with self._lock:
+            stage = self.stages.get(name)
+            if None in [stage]:
+                self.stages[name] = [1, seconds, seconds]
+            else:
+                stage[0] += 1
+                stage[1] += seconds
+                stage[2] = max(stage[2], seconds)
+
+    def count(self, name, value=1):
+        '''count() - add value to counter name'''
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def elapsed(self):
+        '''elapsed() - seconds since the timer started'''
+        return self.clock() - self.started
+
+    def report(self):
+        '''
+        report() - breakdown table, stages in the order they first finished
+
+        Returns:
+            str: one line per stage and counter, plus the wall time since
+            the timer started
+        '''
+        wall = self.elapsed()
+        lines = ["{0:16} {1:>8} {2:>10} {3:>10} {4:>10} {5:>6}".format(
+            'stage', 'calls', 'total s', 'mean ms', 'max ms', '% wall')]
+        with self._lock:
+            for name, (calls, total, slowest) in self.stages.items():
+                lines.append("{0:16} {1:8d} {2:10.4f} {3:10.3f} {4:10.3f} {5:6.1f}".format(
+                    name, calls, total, total / calls * 1000, slowest * 1000,
+                    total / wall * 100 if wall else 0.0))
+            lines.append("{0:16} {1:>8} {2:10.4f}".format('wall', '', wall))
+            for name, value in self.counters.items():
+                lines.append("{0:16} {1:8d}".format(name, value))
+        return "\n".join(lines)
+
+
+#
+##############################################################################
+#
+# RunMetrics()
+#
+class RunMetrics(StageTimer):
+    '''
+    RunMetrics - StageTimer that also keeps a latency histogram per stage
+
+    At the end of a run write() saves the counters, gauges and histograms
+    as a Prometheus textfile (for node_exporter's textfile collector) or,
+    for a path ending in .json, as JSON. Every name is prefixed with
+    secret_santa_ and stage histograms share secret_santa_stage_seconds with
+    a stage label. The counters start from 0 every run, so they are exported
+    as gauges: a Prometheus counter must never go down.
+    '''
+    PREFIX = 'secret_santa_'
+    # always exported, so a quiet run reports 0 instead of no series
+    COUNTERS = ('pairing_attempts', 'messages_sent', 'smtp_retries', 'smtp_failures')
+    # upper bounds in seconds, +Inf is implied
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    HELP = {
+        'stage_seconds': 'Seconds spent per call of each stage of the last run.',
+        'pairing_attempts': 'Pairing draws or searches tried in the last run.',
+        'messages_sent': 'Notification emails delivered in the last run.',
+        'smtp_retries': 'Transient SMTP failures retried in the last run.',
+        'smtp_failures': 'Notification emails that could not be delivered in the last run.',
+        'last_run_timestamp_seconds': 'Unix time the last run finished.',
+        'last_run_seconds': 'Wall time of the last run.',
+        'last_run_success': '1 if the last run finished without errors, else 0.',
+    }
+
+    def __init__(self, clock=time.perf_counter, buckets=None):
+        super(RunMetrics, self).__init__(clock=clock)
+        self.counters.update((name, 0) for name in self.COUNTERS)
+        self.buckets = tuple(sorted(buckets or self.BUCKETS))
+        # stage name -> per bucket counts (not cumulative), last one is +Inf
+        self.histograms = {}
+        self.gauges = {}
+
+    def add(self, name, seconds):
+        '''add() - record one call of stage name in its totals and histogram'''
+        super(RunMetrics, self).add(name, seconds)
+        with self._lock:
+            counts = self.histograms.get(name)
+            if None in [counts]:
+                counts = self.histograms[name] = [0] * (len(self.buckets) + 1)
+            for idx, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[idx] += 1
+                    break
+            else:
+                counts[-1] += 1
+
+    def gauge(self, name, value):
+        '''gauge() - set gauge name to value'''
+        with self._lock:
+            self.gauges[name] = value
+
+    def as_dict(self):
+        '''
+        as_dict() - everything recorded so far
+
+        Returns:
+            dict: counters, gauges and per stage histograms with cumulative
+            bucket counts keyed by upper bound
+        '''
+        histograms = {}
+        with self._lock:
+            for name, counts in self.histograms.items():
+                calls, total, _ = self.stages[name]
+                buckets = {}
+                seen = 0
+                for bound, bucket in zip([str(bound) for bound in self.buckets] + ['+Inf'],
+                                         counts):
+                    seen += bucket
+                    buckets[bound] = seen
+                histograms[name] = {'count': calls, 'sum': total, 'buckets': buckets}
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': histograms,
+            }
+
+    def prometheus(self):
+        '''
+        prometheus() - everything recorded so far in the Prometheus text format
+
+        Returns:
+            str: exposition text, newline terminated
+        '''
+        data = self.as_dict()
+        lines = []
+
+        def family(name, kind):
+            lines.append('# HELP {0}{1} {2}'.format(self.PREFIX, name, self.HELP.get(name, name)))
+            lines.append('# TYPE {0}{1} {2}'.format(self.PREFIX, name, kind))
+
+        gauges = dict(data['counters'])
+        gauges.update(data['gauges'])
+        for name, value in sorted(gauges.items()):
+            family(name, 'gauge')
+            lines.append('{0}{1} {2}'.format(self.PREFIX, name, value))
+        if data['histograms']:
+            family('stage_seconds', 'histogram')
+            for stage, histogram in data['histograms'].items():
+                for bound, seen in histogram['buckets'].items():
+                    lines.append('{0}stage_seconds_bucket{{stage="{1}",le="{2}"}} {3}'.format(
+                        self.PREFIX, stage, bound, seen))
+                lines.append('{0}stage_seconds_sum{{stage="{1}"}} {2!r}'.format(
+                    self.PREFIX, stage, histogram['sum']))
+                lines.append('{0}stage_seconds_count{{stage="{1}"}} {2}'.format(
+                    self.PREFIX, stage, histogram['count']))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        '''
+        write() - save the metrics to path, JSON if it ends in .json
+
+        Written to a temp file and renamed, so a collector never reads half
+        a file.
+        '''
+        if str(path).endswith('.json'):
+            text = json.dumps(self.as_dict(), sort_keys=True, indent=4, separators=(',', ': '))
+            text += "\n"
+        else:
+            text = self.prometheus()
+        temp = '{0}.tmp'.format(path)
+        with open(temp, 'w', encoding='utf-8') as handle:
+            handle.write(text)
+        os.replace(temp, path)
+        self._logger.info("Wrote metrics to '%s'", path)
+
+
 #
 ##############################################################################
 #
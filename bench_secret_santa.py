@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+#
+'''
+bench_secret_santa.py - Time secret_santa.py stages on synthetic rosters
+'''
+#
+# Future imports
+#
+from __future__ import print_function
+#
+# Standard imports
+#
+import argparse
+import contextlib
+import io
+import json
+import logging
+import platform
+import random
+import sys
+import time
+try:
+    from pathlib import Path
+except ModuleNotFoundError:
+    # Python 2.x? Add pathlib2 to your requirements.txt
+    from pathlib2 import Path
+#
+# Non-standard imports
+#
+
+#
+# Ensure . is in the lib path for local includes
+#
+LIB_PATH = Path(__file__).resolve().parent
+sys.path.insert(0, str(LIB_PATH))
+# pylint: disable=wrong-import-position
+### local directory imports here
+import secret_santa
+from SecretSanta import ExclusionIndex, Participant, ParticipantTable, Person
+from smtp_sink import SmtpSink
+#
+##############################################################################
+#
+# Global variables
+#
+DEFAULT_LOG_LEVEL = 'WARNING'
+
+DEFAULT_SIZES = '10,100,1000,10000'
+DEFAULT_EXCLUSIONS = '0,2,10'
+DEFAULT_REPEAT = 3
+
+# givers timed individually in the choose_reciever stage
+CHOOSE_SAMPLE = 100
+
+# messages pushed through the local SMTP sink per --smtp run
+DEFAULT_SMTP_MESSAGES = 1000
+
+HELP_MESSAGE = '''
+Generate synthetic PARTICIPANTS rosters of each size, with each person
+excluding a number of random others in dont_pair, and time every stage of a
+secret santa run against them. Results are written as JSON.
+
+Sizes of 100000 and up build an n * n bit allowed-pairs graph for every
+method but numpy, so expect gigabytes of memory there.
+
+With --smtp, send_emails() is also timed for real through the threaded pool
+and the async sender against a local smtp_sink.py server, with optional
+latency and failure injection, and messages/second is reported.
+'''
+
+CONFIG = {
+    'TIMEZONE': 'US/Eastern',
+    'FROM': 'secret-santa@example.com',
+    'SUBJECT': 'Your secret santa recipient is {santee}',
+    'MESSAGE': "Dear {santa},\n\nThis year you are {santee}'s Secret Santa!. Ho Ho Ho!\n\n"
+               "Provided wish list information:\n\n    {wish_list}\n",
+}
+#
+##############################################################################
+#
+# _get_logger() - reuable code to get the correct logger by name
+#
+def _get_logger():
+    '''
+    Reusable code to get the correct logger by name of current file
+
+    Returns:
+        logging.logger: Instance of logger for name of current file
+    '''
+    return logging.getLogger(Path(__file__).resolve().name)
+
+
+#
+##############################################################################
+#
+# make_participants()
+#
+def make_participants(size, exclusions, seed=None):
+    '''
+    make_participants() - a synthetic PARTICIPANTS list
+
+    Returns:
+        list: dicts shaped like the PARTICIPANTS entries in config.yml
+    '''
+    rng = random.Random(seed)
+    width = len(str(size))
+    names = ['Person {0:0{1}d}'.format(idx, width) for idx in range(size)]
+    participants = []
+    for idx, name in enumerate(names):
+        dont_pair = None
+        if exclusions:
+            dont_pair = [names[other] for other in rng.sample(range(size), min(exclusions, size))
+                         if other != idx]
+        participants.append({
+            'name': name,
+            'email': 'person{0}@example.com'.format(idx),
+            'wish_list': 'example.com/wish/{0}'.format(idx),
+            'dont_pair': dont_pair,
+        })
+    return participants
+
+
+#
+##############################################################################
+#
+# _timed() - best of repeat
+#
+def _timed(func, repeat):
+    '''
+    Call func repeat times with stdout silenced
+
+    Returns:
+        tuple: (fastest wall time in seconds, result of the last call)
+    '''
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if None in [best] else min(best, elapsed)
+    return best, result
+
+
+#
+##############################################################################
+#
+# bench_roster()
+#
+def bench_roster(size, exclusions, repeat=DEFAULT_REPEAT, seed=None):
+    '''
+    bench_roster() - time every stage for one roster
+
+    Returns:
+        list: one result dict per stage
+    '''
+    logger = _get_logger()
+    participants = make_participants(size, exclusions, seed=seed)
+    results = []
+
+    def record(stage, seconds, **extra):
+        result = {'size': size, 'exclusions': exclusions, 'stage': stage, 'seconds': seconds}
+        result.update(extra)
+        logger.info("%s", json.dumps(result, sort_keys=True))
+        results.append(result)
+
+    seconds, givers = _timed(lambda: [Person(**person) for person in participants], repeat)
+    record('build_people', seconds)
+
+    seconds, _ = _timed(lambda: ExclusionIndex(givers), repeat)
+    record('exclusion_index', seconds)
+
+    records = [Participant.from_dict(person) for person in participants]
+    seconds, table = _timed(lambda: ParticipantTable(records), repeat)
+    record('participant_table', seconds)
+
+    def find_table():
+        try:
+            return secret_santa.find_pairs(table, table)
+        except RuntimeError:
+            return None, None
+    seconds, (found, strategy) = _timed(find_table, repeat)
+    record('find_pairs_table', seconds, method=secret_santa.DEFAULT_METHOD, strategy=strategy,
+           found=None not in [found])
+    recievers = givers[:]
+
+    sample = givers[:CHOOSE_SAMPLE]
+
+    def choose():
+        stuck = 0
+        for giver in sample:
+            try:
+                giver.choose_reciever(recievers)
+            except RuntimeError:
+                stuck += 1
+        return stuck
+    seconds, stuck = _timed(choose, repeat)
+    record('choose_reciever', seconds / len(sample), calls=len(sample), stuck=stuck)
+
+    for order in secret_santa.ORDERS:
+        def search(order=order):
+            return secret_santa.search_pairs(givers, recievers, order=order)
+        seconds, (pairs, attempts) = _timed(search, repeat)
+        record('search_pairs', seconds, order=order, attempts=attempts,
+               max_attempts=secret_santa.MAX_SEARCHES, found=None not in [pairs])
+
+    for method in secret_santa.METHODS:
+        def find(method=method):
+            try:
+                return secret_santa.find_pairs(givers, recievers, method=method)
+            except RuntimeError:
+                return None, None
+        seconds, (found, strategy) = _timed(find, repeat)
+        record('find_pairs', seconds, method=method, strategy=strategy,
+               found=None not in [found])
+        if None not in [found]:
+            pairs = found
+
+    if None in [pairs]:
+        return results
+
+    seconds, _ = _timed(lambda: secret_santa.pairs_summary(pairs), repeat)
+    record('pairs_summary', seconds)
+
+    seconds, _ = _timed(lambda: secret_santa.send_emails(config=CONFIG, pairs=pairs, fake=True),
+                        repeat)
+    record('send_emails_fake', seconds, per_message=seconds / len(pairs))
+
+    return results
+
+
+#
+##############################################################################
+#
+# bench_smtp()
+#
+def bench_smtp(messages, pool_sizes, latency=0.0, fail_rate=0.0, seed=None):
+    '''
+    bench_smtp() - time real deliveries through send_emails() against a sink
+
+    Returns:
+        list: one result dict per sender and pool size
+    '''
+    logger = _get_logger()
+    givers = [Person(**person) for person in make_participants(messages, 0, seed=seed)]
+    pairs, _ = secret_santa.find_pairs(givers, givers[:], method='match')
+    results = []
+
+    with SmtpSink(latency=latency, fail_rate=fail_rate, seed=seed) as sink:
+        config = dict(CONFIG, SMTP_SERVER=sink.host, SMTP_PORT=sink.port,
+                      USERNAME='bench', PASSWORD='bench', SMTP_STARTTLS=False,
+                      SMTP_BACKOFF=0.01)
+        for use_async in [False, True]:
+            for size in pool_sizes:
+                before = sink.stats()
+                start = time.perf_counter()
+                error = None
+                try:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        secret_santa.send_emails(config=dict(config, SMTP_POOL_SIZE=size),
+                                                 pairs=pairs, fake=False, use_async=use_async)
+                except RuntimeError as err:
+                    error = str(err).split("\n", 1)[0]
+                seconds = time.perf_counter() - start
+                after = sink.stats()
+                delivered = after['messages'] - before['messages']
+                result = {
+                    'stage': 'send_emails_smtp',
+                    'sender': 'async' if use_async else 'pool',
+                    'pool_size': size,
+                    'messages': len(pairs),
+                    'delivered': delivered,
+                    'injected_failures': after['failures'] - before['failures'],
+                    'connections': after['connections'] - before['connections'],
+                    'latency': latency,
+                    'fail_rate': fail_rate,
+                    'seconds': seconds,
+                    'per_second': delivered / seconds if seconds else None,
+                    'error': error,
+                }
+                logger.info("%s", json.dumps(result, sort_keys=True))
+                results.append(result)
+    return results
+
+
+#
+##############################################################################
+#
+# handle_arguments()
+#
+def handle_arguments():
+    '''
+    Handle CLI arguments
+
+    Returns:
+        parser.Namespace: Representation of the parsed arguments
+    '''
+    parser = argparse.ArgumentParser(description=HELP_MESSAGE)
+
+    parser.add_argument('-l', '--log-level', action='store', required=False,
+                        choices=["debug", "info", "warning", "error", "critical"],
+                        default=DEFAULT_LOG_LEVEL,
+                        help='Logging verbosity. Default: {}'.format(DEFAULT_LOG_LEVEL))
+
+    parser.add_argument('--sizes', action='store', required=False, default=DEFAULT_SIZES,
+                        help='Comma separated roster sizes. Default: {}'.format(DEFAULT_SIZES))
+
+    parser.add_argument('--exclusions', action='store', required=False,
+                        default=DEFAULT_EXCLUSIONS,
+                        help='Comma separated dont_pair lengths. Default: {}'.format(
+                            DEFAULT_EXCLUSIONS))
+
+    parser.add_argument('-r', '--repeat', action='store', required=False, type=int,
+                        default=DEFAULT_REPEAT,
+                        help='Runs per stage, the fastest is kept. Default: {}'.format(
+                            DEFAULT_REPEAT))
+
+    parser.add_argument('--seed', action='store', required=False, type=int, default=None,
+                        help='Seed for the rosters and the pairing search')
+
+    parser.add_argument('--smtp', action='store_true', required=False, default=False,
+                        help='Also time real sends through a local SMTP sink')
+
+    parser.add_argument('--smtp-messages', action='store', required=False, type=int,
+                        default=DEFAULT_SMTP_MESSAGES,
+                        help='Messages per --smtp run. Default: {}'.format(DEFAULT_SMTP_MESSAGES))
+
+    parser.add_argument('--smtp-pools', action='store', required=False, default='1,8',
+                        help='Comma separated SMTP_POOL_SIZE values for --smtp. Default: 1,8')
+
+    parser.add_argument('--smtp-latency', action='store', required=False, type=float,
+                        default=0.0,
+                        help='Seconds the sink waits per message. Default: 0')
+
+    parser.add_argument('--smtp-fail-rate', action='store', required=False, type=float,
+                        default=0.0,
+                        help='Chance the sink answers a command with 451. Default: 0')
+
+    parser.add_argument('-o', '--output', action='store', required=False, default=None,
+                        help='Write the JSON results here instead of stdout')
+
+    return parser.parse_args()
+
+
+#
+##############################################################################
+#
+# main
+#
+def main():
+    '''main() - Handle the arguments and run the benchmarks'''
+    args = handle_arguments()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s:%(name)s.%(funcName)s:%(message)s',
+                        level=getattr(logging, args.log_level.upper()))
+
+    if None not in [args.seed]:
+        random.seed(args.seed)
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for exclusions in [int(count) for count in args.exclusions.split(',')]:
+            results.extend(bench_roster(size, exclusions, repeat=args.repeat, seed=args.seed))
+
+    if args.smtp:
+        results.extend(bench_smtp(args.smtp_messages,
+                                  [int(size) for size in args.smtp_pools.split(',')],
+                                  latency=args.smtp_latency, fail_rate=args.smtp_fail_rate,
+                                  seed=args.seed))
+
+    output = json.dumps({
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'seed': args.seed,
+        'results': results,
+    }, sort_keys=True, indent=4, separators=(',', ': '))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as handle:
+            handle.write(output + "\n")
+    else:
+        print(output)
+
+
+#
+##############################################################################
+#
+# do it
+#
+if __name__ == "__main__":
+    main()
@@ -12,8 +12,11 @@ from __future__ import print_function
 # Standard imports
 #
 import argparse
+import contextlib
+import cProfile
+import csv
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 import datetime
-from email.mime.text import MIMEText
 import json
 import logging
 try:
@@ -22,14 +25,18 @@ except ModuleNotFoundError:
     # Python 2.x? Add pathlib2 to your requirements.txt
     from pathlib2 import Path
 import random
-import smtplib
-import socket
+import sys
 import time
 #
 # Non-standard imports
 #
 import pytz
 import yaml
+try:
+    import numpy
+except ImportError:
+    # optional, for --method numpy
+    numpy = None
 
 #
 # Ensure . is in the lib path for local includes
@@ -37,7 +44,10 @@ import yaml
 LIB_PATH = Path(__file__).resolve().parent
 # pylint: disable=wrong-import-position
 ### local directory imports here
-from SecretSanta import Person, Pair
+from SecretSanta import (AsyncSmtpSender, ConfigCache, DerangementSampler, ExclusionIndex,
+                         GiverQueue, Matcher, MessageFactory, NumpyPairing, Pair,
+                         PairingGraph, PairingSnapshot, Participant, ParticipantTable, Person,
+                         RateLimiter, RunMetrics, SendJournal, SmtpPool, StageTimer)
 #
 ##############################################################################
 #
@@ -47,6 +57,28 @@ DEFAULT_LOG_LEVEL = 'WARNING'
 
 MAX_SEARCHES = 100
 
+MAX_SAMPLES = 1000
+
+# SMTP_POOL_SIZE / SMTP_MAX_PER_CONNECTION / SMTP_TIMEOUT defaults when not in config.yml
+DEFAULT_POOL_SIZE = 1
+DEFAULT_ASYNC_POOL_SIZE = 8
+DEFAULT_MAX_PER_CONNECTION = 100
+DEFAULT_SMTP_TIMEOUT = 30
+
+# SMTP_RETRIES / SMTP_BACKOFF defaults, SMTP_RATE and SMTP_BURST are unset by default
+DEFAULT_SMTP_RETRIES = 3
+DEFAULT_SMTP_BACKOFF = 1.0
+
+METHODS = ('auto', 'match', 'search', 'numpy')
+DEFAULT_METHOD = 'auto'
+
+# order create_pairs() takes the givers in, see GiverQueue for 'mrv'
+ORDERS = ('random', 'mrv')
+DEFAULT_ORDER = 'random'
+
+# NumpyPairing.repair() rounds before --method numpy gives up
+MAX_REPAIR_ROUNDS = 1000
+
 HELP_MESSAGE = '''
 To use, fill out config.yml with your own participants. You can also specify
 DONT-PAIR so that people don't get assigned their significant other.
@@ -57,19 +89,34 @@ for routing mail through gmail.
 For more information, see README.
 '''
 
+# plus PARTICIPANTS or PARTICIPANTS_FILE
 REQUIRED = (
     'SMTP_SERVER',
     'SMTP_PORT',
     'USERNAME',
     'PASSWORD',
     'TIMEZONE',
-    'PARTICIPANTS',
     'FROM',
     'SUBJECT',
     'MESSAGE',
 )
 
+# libyaml's parser when PyYAML was built with it, it is many times faster
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# separates names in the dont_pair column of a CSV roster
+CSV_NAME_SEPARATOR = ';'
+
+# per-process state for parallel_search_pairs() workers
+_WORKER = {}
+
 CONFIG_PATH = str(Path(__file__).resolve().parent / 'config.yml')
+
+# parsed config and compiled participants, see cached_config()
+CACHE_PATH = str(Path(__file__).resolve().parent / '.config.cache')
+
+# where send journals go unless config.yml sets JOURNAL_DIR
+JOURNAL_DIR = str(Path(__file__).resolve().parent / 'journal')
 #
 ##############################################################################
 #
@@ -106,6 +153,23 @@ def _get_logger():
     return logging.getLogger(Path(__file__).resolve().name)
 
 
+#
+##############################################################################
+#
+# _stage() - time a block when profiling
+#
+def _stage(timer, name):
+    '''
+    timer.stage(name), or a no-op when timer is None (no --profile)
+
+    Returns:
+        context manager
+    '''
+    if None in [timer]:
+        return contextlib.nullcontext()
+    return timer.stage(name)
+
+
 #
 ##############################################################################
 #
@@ -113,7 +177,263 @@ def _get_logger():
 #
 def parse_yaml(yaml_path=CONFIG_PATH):
     '''parse_yaml() - load the config file'''
-    return yaml.safe_load(open(yaml_path, 'rb'))
+    with open(yaml_path, 'rb') as handle:
+        return yaml.load(handle, Loader=YAML_LOADER)
+
+
+#
+##############################################################################
+#
+# load_participants()
+#
+def load_participants(path):
+    '''
+    load_participants() - stream a roster file one participant at a time
+
+    .csv files have name, email, wish_list and dont_pair columns, with
+    dont_pair names separated by ';'. .jsonl files have one PARTICIPANTS
+    style object per line. .yml/.yaml files hold a list of them, read
+    entry by entry instead of as one document.
+
+    Returns:
+        generator: Participant for every entry, in file order
+    '''
+    suffix = Path(path).suffix.lower()
+    if suffix == '.csv':
+        reader = _read_csv_roster
+    elif suffix in ('.jsonl', '.ndjson'):
+        reader = _read_jsonl_roster
+    elif suffix in ('.yml', '.yaml'):
+        reader = _read_yaml_roster
+    else:
+        raise RuntimeError("Unknown roster format '{0}', use .csv, .jsonl or .yml".format(path))
+
+    for where, entry in reader(path):
+        yield Participant.from_dict(entry, where)
+
+
+#
+##############################################################################
+#
+# _read_csv_roster() / _read_jsonl_roster() / _read_yaml_roster() - load_participants() readers
+#
+def _read_csv_roster(path):
+    '''_read_csv_roster() - (where, dict) per row, empty cells left out'''
+    # utf-8-sig drops the byte order mark Excel and many exports start with
+    with open(path, newline='', encoding='utf-8-sig') as handle:
+        rows = csv.DictReader(handle)
+        for row in rows:
+            where = '{0}:{1}'.format(path, rows.line_num)
+            entry = {key: value.strip() for key, value in row.items()
+                     if None not in [key, value] and value.strip()}
+            if None in row:
+                raise RuntimeError("{0}: more cells than columns".format(where))
+            if 'dont_pair' in entry:
+                entry['dont_pair'] = [name.strip() for name in
+                                      entry['dont_pair'].split(CSV_NAME_SEPARATOR) if name.strip()]
+            yield where, entry
+
+
+def _read_jsonl_roster(path):
+    '''_read_jsonl_roster() - (where, dict) per non-blank line'''
+    with open(path, encoding='utf-8') as handle:
+        for number, line in enumerate(handle, 1):
+            if not line.strip():
+                continue
+            where = '{0}:{1}'.format(path, number)
+            try:
+                yield where, json.loads(line)
+            except ValueError as err:
+                raise RuntimeError("{0}: {1}".format(where, err))
+
+
+def _read_yaml_roster(path):
+    '''
+    _read_yaml_roster() - (where, object) per item of a top-level YAML list
+
+    Pulls parser events and composes one list item at a time, so only the
+    current entry is ever held as YAML nodes. The list must be the only
+    document in the file.
+    '''
+    with open(path, 'rb') as handle:
+        loader = YAML_LOADER(handle)
+        try:
+            loader.get_event()
+            if loader.check_event(yaml.StreamEndEvent):
+                return
+            loader.get_event()
+            if not loader.check_event(yaml.SequenceStartEvent):
+                raise RuntimeError("'{0}' must be a list of participants".format(path))
+            loader.get_event()
+            anchors = {}
+            while not loader.check_event(yaml.SequenceEndEvent):
+                node = _compose_yaml(loader, anchors)
+                where = '{0}:{1}'.format(path, node.start_mark.line + 1)
+                yield where, loader.construct_document(node)
+            loader.get_event()
+            loader.get_event()
+            if not loader.check_event(yaml.StreamEndEvent):
+                raise RuntimeError("'{0}' has more than one YAML document at line {1}, "
+                                   "put every participant in one list".format(
+                                       path, loader.peek_event().start_mark.line + 1))
+        finally:
+            loader.dispose()
+
+
+def _compose_yaml(loader, anchors):
+    '''
+    _compose_yaml() - the node for the next value in the event stream
+
+    What yaml.composer.Composer does, but usable with CSafeLoader too,
+    whose composer is not reachable from Python.
+    '''
+    event = loader.get_event()
+    if isinstance(event, yaml.AliasEvent):
+        if event.anchor not in anchors:
+            raise RuntimeError("Unknown YAML alias '{0}' at {1}".format(event.anchor,
+                                                                      event.start_mark))
+        return anchors[event.anchor]
+
+    if isinstance(event, yaml.ScalarEvent):
+        tag = event.tag
+        if tag in [None, '!']:
+            tag = loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+        node = yaml.ScalarNode(tag, event.value, event.start_mark, event.end_mark,
+                               style=event.style)
+    elif isinstance(event, yaml.SequenceStartEvent):
+        tag = event.tag
+        if tag in [None, '!']:
+            tag = loader.resolve(yaml.SequenceNode, None, event.implicit)
+        node = yaml.SequenceNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        while not loader.check_event(yaml.SequenceEndEvent):
+            node.value.append(_compose_yaml(loader, anchors))
+        node.end_mark = loader.get_event().end_mark
+    else:
+        tag = event.tag
+        if tag in [None, '!']:
+            tag = loader.resolve(yaml.MappingNode, None, event.implicit)
+        node = yaml.MappingNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _compose_yaml(loader, anchors)
+            node.value.append((key, _compose_yaml(loader, anchors)))
+        node.end_mark = loader.get_event().end_mark
+
+    if event.anchor:
+        anchors[event.anchor] = node
+    return node
+
+
+#
+##############################################################################
+#
+# load_config()
+#
+def load_config(config_path=CONFIG_PATH, timer=None, table=False, fingerprint=None):
+    '''
+    load_config() - read and check config.yml and build every Person from it,
+    or one ParticipantTable with table
+
+    fingerprint, if given, is called with each file's path just before the
+    file is read (see ConfigCache.fingerprint()).
+
+    Returns:
+        tuple: (config without PARTICIPANTS, list of Person with their
+        dont_pair lists compiled or a ParticipantTable, paths of the files
+        read, or what fingerprint returned for them)
+    '''
+    logger = _get_logger()
+    source = fingerprint or (lambda path: path)
+    sources = []
+
+    try:
+        sources.append(source(config_path))
+        with _stage(timer, 'yaml_parse'):
+            config = parse_yaml(config_path)
+    except (Exception) as err:
+        error = "Error reading config '{0}': '{1}'".format(config_path, err)
+        logger.error(error)
+        raise RuntimeError(error)
+
+    # add some xmas emoji hotness
+    config['MESSAGE'] += "\n" + "🌲   " * 10 + "\n\n" + "  🎅 " * 9 + "\n\n" + "🌲   " * 10
+
+    logger.debug("Message template is: %s", config['MESSAGE'])
+
+    for key in REQUIRED:
+        if key not in config.keys():
+            error = 'Required parameter "{0}" not in yaml config file!'.format(key)
+            logger.error(error)
+            raise RuntimeError(error)
+
+    if config.get('PARTICIPANTS_FILE'):
+        # relative to config.yml
+        roster = str(Path(config_path).parent / config['PARTICIPANTS_FILE'])
+        sources.append(source(roster))
+        participants = load_participants(roster)
+    elif config.get('PARTICIPANTS'):
+        participants = (Participant.from_dict(entry, 'PARTICIPANTS[{0}]'.format(idx))
+                        for idx, entry in enumerate(config['PARTICIPANTS']))
+    else:
+        error = 'Required parameter "PARTICIPANTS" or "PARTICIPANTS_FILE" not in yaml config file!'
+        logger.error(error)
+        raise RuntimeError(error)
+
+    if table:
+        with _stage(timer, 'participant_table'):
+            givers = ParticipantTable(participants)
+    else:
+        givers = []
+        with _stage(timer, 'build_people'):
+            for record in participants:
+                givers.append(Person(*record))
+    # only the Person objects (or table) are needed from here on
+    config.pop('PARTICIPANTS', None)
+
+    if len(givers) < 2:
+        raise Exception('Not enough participants specified.')
+
+    if not table:
+        # compile dont_pair names into integer ids once
+        with _stage(timer, 'exclusion_index'):
+            ExclusionIndex(givers)
+
+    return config, givers, sources
+
+
+#
+##############################################################################
+#
+# cached_config()
+#
+def cached_config(config_path=CONFIG_PATH, use_cache=True, timer=None, table=False):
+    '''
+    cached_config() - load_config(), reusing CACHE_PATH while neither
+    config.yml nor its roster file have changed
+
+    Returns:
+        tuple: (config, list of Person or ParticipantTable)
+    '''
+    if not use_cache:
+        config, givers, _ = load_config(config_path, timer=timer, table=table)
+        return config, givers
+
+    cache = ConfigCache(CACHE_PATH)
+    with _stage(timer, 'config_cache'):
+        payload = cache.load()
+    if None not in [payload] and payload['config_path'] == str(config_path) and \
+            payload.get('table', False) == table:
+        _get_logger().info("Using cached config from '%s'", CACHE_PATH)
+        return payload['config'], payload['givers']
+
+    # fingerprinted before parsing, so a file edited mid-read can only cause a miss
+    config, givers, sources = load_config(config_path, timer=timer, table=table,
+                                          fingerprint=ConfigCache.fingerprint)
+    try:
+        cache.save(sources, {'config_path': str(config_path), 'config': config, 'givers': givers,
+                             'table': table})
+    except OSError as err:
+        _get_logger().warning("Could not write cache '%s': '%s'", CACHE_PATH, err)
+    return config, givers
 
 
 #
@@ -121,37 +441,350 @@ def parse_yaml(yaml_path=CONFIG_PATH):
 #
 # create_pairs()
 #
-def create_pairs(old_givers=None, old_recievers=None):
+def create_pairs(old_givers=None, old_recievers=None, graph=None, order=DEFAULT_ORDER):
     '''
     create_pairs() - match givers and recievers
+
+    Candidate recievers are filtered with the PairingGraph bitsets instead of
+    copying and scanning reciever lists. A giver left without candidates
+    takes a reciever from already matched givers, who move on to free ones
+    (PairingGraph.augment()), instead of the whole search starting over.
+    Givers go in random order, or with order='mrv' the one with the fewest
+    recievers left goes next (GiverQueue) so that heavily excluded people
+    are not left until their few options are gone.
     '''
     logger = _get_logger()
     pairs = None
     if None not in [old_givers, old_recievers]:
 
-        givers = old_givers[:]
-        recievers = old_recievers[:]
-        pairs = []
+        if None in [graph]:
+            graph = PairingGraph(old_givers, old_recievers)
+        available = graph.full
+        match = {}
+        owner = {}
 
-        # randomize the array of givers, otherwise config position can limit
-        random.shuffle(givers)
-        random.shuffle(givers)
-        for giver in givers:
-            logger.info("Finding match for %s", giver)
-            try:
-                reciever = giver.choose_reciever(recievers)
-                recievers.remove(reciever)
-                pairs.append(Pair(giver, reciever))
-            # pylint: disable=broad-except
-            except Exception as err:
-                logger.info("Exception '%s', RESTART", err)
-                pairs = None
-                raise RuntimeError("Restarting the search")
-                # NOTE: recursing here was causing issues
-                # return create_pairs(old_givers, old_recievers)
+        queue = None
+        if order == 'mrv':
+            queue = GiverQueue(graph)
+            next_giver = queue.pop
+        else:
+            # randomize the array of givers, otherwise config position can limit
+            shuffled = list(range(len(old_givers)))
+            random.shuffle(shuffled)
+            next_giver = shuffled.pop
+
+        givers = []
+        for _ in range(len(old_givers)):
+            giver = next_giver()
+            givers.append(giver)
+            logger.info("Finding match for %s", old_givers[giver])
+            candidates = graph.candidates(giver, available)
+            if candidates:
+                reciever = graph.pick(candidates)
+                match[giver] = reciever
+                owner[reciever] = giver
+            else:
+                logger.info("No recievers left for %s, repairing", old_givers[giver])
+                reciever = graph.augment(giver, match, owner, available)
+                if None in [reciever]:
+                    raise RuntimeError("No valid reciever for {0}".format(old_givers[giver]))
+            available ^= 1 << reciever
+            if None not in [queue]:
+                queue.taken(reciever)
+        pairs = [Pair(old_givers[giver], old_recievers[match[giver]]) for giver in givers]
+    return pairs
+
+
+#
+##############################################################################
+#
+# search_pairs()
+#
+def search_pairs(givers=None, recievers=None, max_attempts=MAX_SEARCHES, graph=None,
+                 order=DEFAULT_ORDER):
+    '''
+    search_pairs() - retry the random create_pairs() search
+
+    Returns:
+        tuple: (list of Pair or None, number of attempts used)
+    '''
+    pairs = None
+    attempts = 0
+    if None in [graph]:
+        graph = PairingGraph(givers, recievers)
+    # loop instead of recursing
+    while None in [pairs] and attempts < max_attempts:
+        try:
+            attempts += 1
+            pairs = create_pairs(givers, recievers, graph=graph, order=order)
+        # pylint: disable=broad-except
+        except Exception:
+            pass
+    return pairs, attempts
+
+
+#
+##############################################################################
+#
+# _search_init() / _search_chunk() - parallel_search_pairs() worker side
+#
+def _search_init(givers, recievers):
+    '''_search_init() - keep the participants and graph in the worker process'''
+    _WORKER['givers'] = givers
+    _WORKER['recievers'] = recievers
+    _WORKER['graph'] = PairingGraph(givers, recievers)
+
+
+def _search_chunk(seed, max_attempts, order=DEFAULT_ORDER):
+    '''
+    _search_chunk() - one seeded run of search_pairs() in a worker process
+
+    Returns:
+        tuple: ((giver index, reciever index) list or None, attempts used)
+    '''
+    random.seed(seed)
+    givers = _WORKER['givers']
+    recievers = _WORKER['recievers']
+    pairs, attempts = search_pairs(givers, recievers, max_attempts, graph=_WORKER['graph'],
+                                   order=order)
+    if None in [pairs]:
+        return None, attempts
+
+    giver_index = {person: idx for idx, person in enumerate(givers)}
+    reciever_index = {person: idx for idx, person in enumerate(recievers)}
+    return [(giver_index[pair.giver], reciever_index[pair.reciever]) for pair in pairs], attempts
+
+
+#
+##############################################################################
+#
+# parallel_search_pairs()
+#
+def parallel_search_pairs(givers=None, recievers=None, max_attempts=MAX_SEARCHES, workers=2,
+                          order=DEFAULT_ORDER):
+    '''
+    parallel_search_pairs() - search_pairs() spread over a process pool
+
+    The attempt budget is cut into small independently seeded chunks. The
+    first chunk to find an assignment wins and the queued ones are cancelled.
+
+    Returns:
+        tuple: (list of Pair or None, number of attempts used)
+    '''
+    logger = _get_logger()
+    chunk = max(1, max_attempts // (workers * 4))
+    sizes = [chunk] * (max_attempts // chunk)
+    if max_attempts % chunk:
+        sizes.append(max_attempts % chunk)
+
+    assignment = None
+    attempts = 0
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_search_init,
+                                   initargs=(givers, recievers))
+    try:
+        pending = set(executor.submit(_search_chunk, random.getrandbits(64), size, order)
+                      for size in sizes)
+        while pending and None in [assignment]:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result, used = future.result()
+                attempts += used
+                if None in [assignment] and None not in [result]:
+                    assignment = result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+    logger.info("%s workers used %s of %s attempts", workers, attempts, max_attempts)
+    if None in [assignment]:
+        return None, attempts
+    return [Pair(givers[giver], recievers[reciever]) for giver, reciever in assignment], attempts
+
+
+#
+##############################################################################
+#
+# match_pairs()
+#
+def match_pairs(givers=None, recievers=None):
+    '''
+    match_pairs() - match givers and recievers with a bipartite matching
+
+    Returns:
+        list: Pair for every giver, or None if the dont_pair lists make a
+        full assignment impossible
+    '''
+    pairs = None
+    if None not in [givers, recievers]:
+        matcher = Matcher(givers, recievers)
+        matcher.match()
+        assignment = matcher.assignment()
+        if None not in [assignment]:
+            pairs = [Pair(givers[giver], recievers[reciever]) for giver, reciever in assignment]
+    return pairs
+
+
+#
+##############################################################################
+#
+# check_feasible()
+#
+def check_feasible(givers=None, recievers=None):
+    '''
+    check_feasible() - fail fast when the dont_pair lists can never work
+
+    Runs one maximum matching before any pairing attempt. If it cannot cover
+    everyone, the error names the participants behind the deadlock.
+
+    Returns:
+        Matcher: the finished matching, reusable as a valid assignment
+    '''
+    matcher = Matcher(givers, recievers)
+    matcher.match()
+
+    witness = matcher.deadlock()
+    if None not in [witness]:
+        side, stuck, options = witness
+        if side == 'giver':
+            stuck = sorted(givers[idx].name for idx in stuck)
+            options = sorted(recievers[idx].name for idx in options)
+            error = "No valid matches exist: {0} can only give to {1}".format(
+                ", ".join(stuck), ", ".join(options) or "nobody")
+        else:
+            stuck = sorted(recievers[idx].name for idx in stuck)
+            options = sorted(givers[idx].name for idx in options)
+            error = "No valid matches exist: {0} can only get gifts from {1}".format(
+                ", ".join(stuck), ", ".join(options) or "nobody")
+        _get_logger().error(error)
+        raise RuntimeError(error)
+    return matcher
+
+
+#
+##############################################################################
+#
+# sample_pairs()
+#
+def sample_pairs(givers=None, recievers=None, max_tries=MAX_SAMPLES, timer=None):
+    '''
+    sample_pairs() - draw a uniformly random valid assignment, counting the
+    draws as pairing_attempts on timer
+
+    Returns:
+        list: Pair for every giver, or None if the sampler is not worth
+        running or gave up after max_tries
+    '''
+    logger = _get_logger()
+    pairs = None
+    if None not in [givers, recievers]:
+        sampler = DerangementSampler(givers, recievers, max_tries=max_tries)
+        expected = sampler.expected_tries()
+        if expected > max_tries:
+            logger.info("Sampler would need ~%.0f tries, skipping it", expected)
+            return None
+
+        assignment = sampler.sample()
+        if None not in [timer]:
+            timer.count('pairing_attempts', sampler.tries)
+        if None not in [assignment]:
+            pairs = [Pair(givers[giver], recievers[reciever]) for giver, reciever in assignment]
+        else:
+            logger.info("Sampler rejected all %s draws (expected ~%.0f)", sampler.tries, expected)
     return pairs
 
 
+#
+##############################################################################
+#
+# numpy_pairs()
+#
+def numpy_pairs(givers=None, recievers=None, max_tries=MAX_SAMPLES,
+                max_rounds=MAX_REPAIR_ROUNDS, timer=None):
+    '''
+    numpy_pairs() - vectorized NumpyPairing draw, repaired when rejection
+    would take too long, counting draws and repair rounds as
+    pairing_attempts on timer
+
+    Returns:
+        list: Pair for every giver, or None if repair gave up
+    '''
+    if None in [numpy]:
+        raise RuntimeError("--method numpy needs numpy, pip install numpy")
+    logger = _get_logger()
+    pairing = NumpyPairing(givers, recievers)
+
+    order = None
+    expected = pairing.expected_tries()
+    if expected <= max_tries:
+        order = pairing.sample(max_tries)
+    else:
+        logger.info("Sampler would need ~%.0f tries, repairing one draw instead", expected)
+    if order is None:
+        order = pairing.repair(max_rounds=max_rounds)
+    if None not in [timer]:
+        timer.count('pairing_attempts', pairing.tries + pairing.rounds)
+    if order is None:
+        return None
+    return [Pair(givers[giver], recievers[reciever]) for giver, reciever in enumerate(order.tolist())]
+
+
+#
+##############################################################################
+#
+# find_pairs()
+#
+def find_pairs(givers=None, recievers=None, method=DEFAULT_METHOD, workers=1, timer=None,
+               order=DEFAULT_ORDER):
+    '''
+    find_pairs() - pair everyone up with the chosen method
+
+    'auto' draws a uniformly random assignment and only falls back to the
+    matching engine when the dont_pair lists make rejection too costly.
+    Like 'numpy' it skips the up front feasibility check, which needs the
+    n * n PairingGraph, unless the draw fails; the fallback then reuses the
+    check's matching. 'search' runs across a process pool when workers is
+    more than 1 and takes the givers in order (see create_pairs()). The
+    attempts made are counted as pairing_attempts on timer.
+
+    Returns:
+        tuple: (list of Pair, name of the strategy that produced them)
+    '''
+    logger = _get_logger()
+
+    if method == 'numpy':
+        pairs = numpy_pairs(givers, recievers, timer=timer)
+        if None not in [pairs]:
+            return pairs, 'numpy'
+        logger.info("NumpyPairing gave up, falling back to the matching")
+
+    if method == 'auto':
+        pairs = sample_pairs(givers, recievers, timer=timer)
+        if None not in [pairs]:
+            return pairs, 'sample'
+
+    matcher = check_feasible(givers, recievers)
+
+    if method == 'search':
+        if workers > 1:
+            pairs, attempts = parallel_search_pairs(givers, recievers, workers=workers,
+                                                    order=order)
+        else:
+            pairs, attempts = search_pairs(givers, recievers, order=order)
+        if None not in [timer]:
+            timer.count('pairing_attempts', attempts)
+        if None in [pairs]:
+            raise RuntimeError("Unable to find matches after {0} attempts!".format(MAX_SEARCHES))
+        logger.info("It took %s tries to match everyone.", attempts)
+        return pairs, 'search'
+
+    if None not in [timer]:
+        timer.count('pairing_attempts')
+
+    pairs = [Pair(givers[giver], recievers[reciever]) for giver, reciever in matcher.assignment()]
+    return pairs, 'match'
+
+
 #
 ##############################################################################
 #
@@ -177,61 +810,178 @@ call with the --send argument:
         print(message)
 
 
+#
+##############################################################################
+#
+# new_run_id()
+#
+def new_run_id():
+    '''
+    new_run_id() - name for a send run's journal
+
+    Returns:
+        str: sortable timestamp plus a random suffix
+    '''
+    return '{0}-{1:04x}'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S'),
+                                random.getrandbits(16))
+
+
+#
+##############################################################################
+#
+# journal_pairs() / restore_pairs()
+#
+def journal_pairs(pairs=None):
+    '''
+    journal_pairs() - describe pairs for the SendJournal
+
+    Returns:
+        list: one dict per Pair, matched back to people by name and email
+    '''
+    return [{'giver': pair.giver.name, 'giver_email': pair.giver.email,
+             'reciever': pair.reciever.name, 'reciever_email': pair.reciever.email}
+            for pair in pairs or []]
+
+
+def restore_pairs(records=None, people=None):
+    '''
+    restore_pairs() - rebuild the Pair list of a journal from the config
+
+    Returns:
+        list: Pair in journal order
+    '''
+    known = {(person.name, person.email): person for person in people or []}
+    pairs = []
+    for record in records or []:
+        giver = known.get((record['giver'], record['giver_email']))
+        reciever = known.get((record['reciever'], record['reciever_email']))
+        if None in [giver, reciever]:
+            raise RuntimeError("Journal pairs '{0}' -> '{1}' no longer match the config!".format(
+                record['giver'], record['reciever']))
+        pairs.append(Pair(giver, reciever))
+    return pairs
+
+
 #
 ##############################################################################
 #
 # send_emails()
 #
-def send_emails(config=None, pairs=None, fake=True):
+def send_emails(config=None, pairs=None, fake=True, use_async=False, journal=None, timer=None):
     '''
     send_emails() - send the secret santa notification emails
+
+    use_async sends through AsyncSmtpSender instead of the threaded SmtpPool.
+    With a SendJournal, pairs must be in journal order: pairs it already
+    marks delivered are skipped and every outcome is recorded in it. A
+    StageTimer gets the mime_build and SMTP stage times.
     '''
     if None not in [config, pairs]:
         logger = _get_logger()
-        server = None
+        pool = None
+        on_result = None
+
+        todo = pairs
+        if None not in [journal]:
+            positions = {id(pair.giver): idx for idx, pair in enumerate(pairs)}
+            todo = [pairs[idx] for idx in journal.pending()]
+            logger.info("Run '%s': %s of %s messages left to send", journal.run_id,
+                        len(todo), len(pairs))
+
+            def record_result(giver, error):
+                journal.record(positions[id(giver)], error)
+            on_result = record_result
 
         if not fake:
-            logger.info("Connecting to: '%s'", config['SMTP_SERVER'])
-            server = smtplib.SMTP(config['SMTP_SERVER'], config['SMTP_PORT'])
-            # server.set_debuglevel(True)
-            server.starttls()
-            server.login(config['USERNAME'], config['PASSWORD'])
+            pool = _make_sender(config, use_async, timer=timer)
+            pool.on_result = on_result
+            pool.start()
 
-        time_zone = pytz.timezone(config['TIMEZONE'])
-        for pair in pairs:
+        try:
+            try:
+                _queue_emails(config, todo, pool, timer=timer)
+            finally:
+                if None not in [pool]:
+                    pool.close()
+        finally:
+            if None not in [journal]:
+                journal.close()
 
-            now = time_zone.localize(datetime.datetime.now())
+        if None not in [pool] and pool.failures:
+            failed = [str(label) for label, _ in pool.failures]
+            if len(failed) > 10:
+                failed = failed[:10] + ['and {0} more'.format(len(failed) - 10)]
+            error = "Failed to email {0} of {1} givers: {2}".format(
+                len(pool.failures), len(todo), ", ".join(failed))
+            if None not in [journal]:
+                error += " (retry them with --resume {0})".format(journal.run_id)
+            logger.error(error)
+            raise RuntimeError(error)
 
-            # Sun, 21 Dec 2008 06:25:23 +0000
-            date = now.strftime('%a, %d %b %Y %T %Z')
-            message_id = '<{random}@{host}>'.format(random=str(time.time()) + str(random.random()),
-                                                    host=socket.gethostname())
 
-            subject = config['SUBJECT'].format(santa=pair.giver.name,
-                                               santee=pair.reciever.name)
+#
+##############################################################################
+#
+# _make_sender() - SMTP delivery engine from the config
+#
+def _make_sender(config, use_async=False, timer=None):
+    '''
+    Build the SmtpPool (or AsyncSmtpSender) and its optional RateLimiter from
+    the SMTP_* settings in config
 
-            mesg = MIMEText(
-                pair.generate_email(message=config['MESSAGE']).encode('utf-8'),
-                _charset='utf-8'
-            )
+    Returns:
+        SmtpSender: not yet started
+    '''
+    limiter = None
+    if config.get('SMTP_RATE'):
+        limiter = RateLimiter(config['SMTP_RATE'], burst=config.get('SMTP_BURST'))
+
+    kwargs = dict(
+        max_per_connection=config.get('SMTP_MAX_PER_CONNECTION', DEFAULT_MAX_PER_CONNECTION),
+        limiter=limiter,
+        max_retries=config.get('SMTP_RETRIES', DEFAULT_SMTP_RETRIES),
+        backoff=config.get('SMTP_BACKOFF', DEFAULT_SMTP_BACKOFF),
+        starttls=config.get('SMTP_STARTTLS', True),
+        timer=timer,
+        timeout=config.get('SMTP_TIMEOUT', DEFAULT_SMTP_TIMEOUT),
+    )
+    if use_async:
+        return AsyncSmtpSender(config['SMTP_SERVER'], config['SMTP_PORT'],
+                               config['USERNAME'], config['PASSWORD'],
+                               size=config.get('SMTP_POOL_SIZE', DEFAULT_ASYNC_POOL_SIZE),
+                               **kwargs)
+    return SmtpPool(config['SMTP_SERVER'], config['SMTP_PORT'],
+                    config['USERNAME'], config['PASSWORD'],
+                    size=config.get('SMTP_POOL_SIZE', DEFAULT_POOL_SIZE),
+                    **kwargs)
+
+
+#
+##############################################################################
+#
+# _queue_emails() - build each message and hand it to the pool
+#
+def _queue_emails(config, pairs, pool=None, timer=None):
+    '''
+    Build the notification for every Pair and submit it to the SmtpPool,
+    or print it when there is no pool (--fake)
+    '''
+    logger = _get_logger()
+    if None not in [config, pairs]:
+        factory = MessageFactory(config['FROM'], config['SUBJECT'], config['MESSAGE'],
+                                 pytz.timezone(config['TIMEZONE']))
 
-            mesg['Date'] = date
-            mesg['Message-Id'] = message_id
-            mesg['From'] = '"{name}" <{email}>'.format(name="Secret Santa", email=config['FROM'])
-            mesg['To'] = '"{name}" <{email}>'.format(name=pair.giver.name, email=pair.giver.email)
-            mesg['Subject'] = subject
+        for pair in pairs:
 
-            if not fake:
-                logger.info("Sending email to: '%s'...", pair.giver.email)
-                result = server.sendmail(config['FROM'], [pair.giver.email], mesg.as_string())
-                logger.debug("Result: '%s'", result)
-                logger.info("Emailed %s", pair.giver)
+            with _stage(timer, 'mime_build'):
+                mesg = factory.build(pair)
+
+            if None not in [pool]:
+                logger.info("Queueing email to: '%s'...", pair.giver.email)
+                pool.submit(config['FROM'], [pair.giver.email], mesg, pair.giver)
             else:
                 print(mesg)
 
-        if None not in [server]:
-            server.quit()
-
 
 #
 ##############################################################################
@@ -256,10 +1006,57 @@ def handle_arguments():
                         default=DEFAULT_LOG_LEVEL,
                         help='Logging verbosity. Default: {}'.format(DEFAULT_LOG_LEVEL))
 
+    parser.add_argument('-m', '--method', action='store', required=False,
+                        choices=METHODS, default=DEFAULT_METHOD,
+                        help='Pairing method. Default: {}'.format(DEFAULT_METHOD))
+
+    parser.add_argument('-w', '--workers', action='store', required=False, type=int, default=1,
+                        help='Processes to spread --method search over. Default: 1')
+
+    parser.add_argument('-o', '--order', action='store', required=False,
+                        choices=ORDERS, default=DEFAULT_ORDER,
+                        help='Order --method search takes the givers in, mrv is most constrained '
+                             'first. Default: {}'.format(DEFAULT_ORDER))
+
     parser.add_argument('-f', '--fake', action='store_true', required=False, default=False)
 
     parser.add_argument('-s', '--send', action='store_true', required=False, default=False)
 
+    parser.add_argument('-r', '--resume', action='store', required=False, default=None,
+                        metavar='RUN_ID',
+                        help='Send only the messages an earlier --send run did not deliver')
+
+    parser.add_argument('--snapshot', action='store', required=False, default=None,
+                        metavar='PATH',
+                        help='Save the pairing to this binary snapshot, or read it with --lookup')
+
+    parser.add_argument('--lookup', action='store', required=False, default=None,
+                        metavar='GIVER',
+                        help="Print one giver's pair from --snapshot without reading the config")
+
+    parser.add_argument('-a', '--async', dest='async_send', action='store_true', required=False,
+                        default=False,
+                        help='Send over concurrent asyncio SMTP sessions')
+
+    parser.add_argument('-t', '--table', action='store_true', required=False, default=False,
+                        help='Hold participants in one columnar table instead of an object each')
+
+    parser.add_argument('--no-cache', action='store_true', required=False, default=False,
+                        help="Re-read config.yml even if it hasn't changed since the last run")
+
+    parser.add_argument('-p', '--profile', action='store_true', required=False, default=False,
+                        help='Print how long each stage of the run took')
+
+    parser.add_argument('--profile-dump', action='store', required=False, default=None,
+                        metavar='PATH',
+                        help='Write cProfile stats of the main thread here '
+                             '(read them with python -m pstats PATH)')
+
+    parser.add_argument('--metrics', action='store', required=False, default=None,
+                        metavar='PATH',
+                        help='Write run metrics here at the end: Prometheus text format, '
+                             'or JSON if PATH ends in .json')
+
     return parser.parse_args()
 
 
@@ -269,7 +1066,7 @@ def handle_arguments():
 # main
 #
 def main():
-    '''main() - Handle the arguments and do the work'''
+    '''main() - Handle the arguments and do the work, profiled with --profile'''
     #
     # Handle CLI args
     #
@@ -279,64 +1076,95 @@ def main():
     logging.basicConfig(format='%(asctime)s %(levelname)s:%(name)s.%(funcName)s:%(message)s',
                         level=getattr(logging, args.log_level.upper()))
 
-    logger = _get_logger()
-
-    logger.info("Log level is '%s'", args.log_level.upper())
-    logger.debug("Arguments were: %s", _json_dump(args.__dict__))
+    if not (args.profile or args.metrics or args.profile_dump):
+        run(args)
+        return
 
+    timer = RunMetrics() if args.metrics else StageTimer()
+    profiler = None
+    if args.profile_dump:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    success = False
     try:
-        config = parse_yaml()
-    except (Exception) as err:
-        error = "Error reading config '{0}': '{1}'".format(CONFIG_PATH, err)
-        logger.error(error)
-        raise RuntimeError(error)
-
-    # add some xmas emoji hotness
-    config['MESSAGE'] += "\n" + "🌲   " * 10 + "\n\n" + "  🎅 " * 9 + "\n\n" + "🌲   " * 10
+        run(args, timer=timer)
+        success = True
+    finally:
+        if None not in [profiler]:
+            profiler.disable()
+            profiler.dump_stats(args.profile_dump)
+        if args.metrics:
+            # written for failed runs too, they are the ones worth alerting on
+            timer.gauge('last_run_seconds', timer.elapsed())
+            timer.gauge('last_run_success', int(success))
+            timer.gauge('last_run_timestamp_seconds', int(time.time()))
+            timer.write(args.metrics)
+        if args.profile:
+            print(timer.report(), file=sys.stderr)
+        if None not in [profiler]:
+            print("cProfile stats written to '{0}'".format(args.profile_dump), file=sys.stderr)
 
-    logger.debug("Message template is: %s", config['MESSAGE'])
 
-    for key in REQUIRED:
-        if key not in config.keys():
-            error = 'Required parameter "{0}" not in yaml config file!'.format(key)
-            logger.error(error)
-            raise RuntimeError(error)
+#
+##############################################################################
+#
+# run()
+#
+def run(args, timer=None):
+    '''run() - the secret santa itself, stages timed when given a StageTimer'''
+    logger = _get_logger()
 
-    participants = config['PARTICIPANTS']
+    logger.info("Log level is '%s'", args.log_level.upper())
+    logger.debug("Arguments were: %s", _json_dump(args.__dict__))
 
-    if len(participants) < 2:
-        raise Exception('Not enough participants specified.')
+    if args.lookup:
+        if not args.snapshot:
+            raise RuntimeError("--lookup needs --snapshot PATH")
+        with PairingSnapshot(args.snapshot) as snapshot:
+            record = snapshot.lookup(args.lookup)
+        if None in [record]:
+            raise RuntimeError("'{0}' is not a giver in '{1}'".format(args.lookup, args.snapshot))
+        print("{0:16} ---> {1}".format(record['giver'], record['reciever']))
+        return
 
-    givers = []
-    for person in participants:
+    config, givers = cached_config(CONFIG_PATH, use_cache=not args.no_cache, timer=timer,
+                                   table=args.table)
 
-        person = Person(**person)
-        givers.append(person)
+    journal_dir = config.get('JOURNAL_DIR', JOURNAL_DIR)
+    journal = None
 
-    recievers = givers[:]
+    if args.resume:
+        # same pairing as the interrupted run, no new search
+        journal = SendJournal.load(journal_dir, args.resume)
+        pairs = restore_pairs(journal.pairs, givers)
+    else:
+        # read only from here on, and a ParticipantTable must be passed as itself
+        recievers = givers
 
-    # loop instead of recursing
-    max_attempts = MAX_SEARCHES
+        with _stage(timer, 'pairing'):
+            pairs, strategy = find_pairs(givers, recievers, method=args.method,
+                                         workers=args.workers, timer=timer, order=args.order)
+        logger.info("Pairing strategy: %s", strategy)
 
-    pairs = None
-    while None in [pairs] and max_attempts > 0:
-        try:
-            max_attempts -= 1
-            pairs = create_pairs(givers, recievers)
-        # pylint: disable=broad-except
-        except Exception:
-            pass
+        if args.send and not args.fake:
+            with _stage(timer, 'journal'):
+                journal = SendJournal.create(journal_dir, new_run_id(), journal_pairs(pairs))
 
-    if None in [pairs]:
-        raise RuntimeError("Unable to find matches after {0} attempts!".format(MAX_SEARCHES))
-    else:
-        logger.info("It took %s tries to match everyone.", (MAX_SEARCHES - max_attempts))
+    if args.snapshot:
+        with _stage(timer, 'snapshot'):
+            PairingSnapshot.write(args.snapshot, journal_pairs(pairs))
+        logger.info("Saved %s pairs to '%s'", len(pairs), args.snapshot)
 
-    if not args.send:
-        pairs_summary(pairs)
+    if not (args.send or args.resume):
+        with _stage(timer, 'summary'):
+            pairs_summary(pairs)
 
-    elif args.send:
-        send_emails(config=config, pairs=pairs, fake=args.fake)
+    else:
+        if None not in [journal]:
+            print("Run ID: {0} (resume with --resume {0})".format(journal.run_id))
+        with _stage(timer, 'send_emails'):
+            send_emails(config=config, pairs=pairs, fake=args.fake, use_async=args.async_send,
+                        journal=journal, timer=timer)
 
 
 #
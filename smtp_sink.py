@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+#
+'''
+smtp_sink.py - Local SMTP server that accepts and drops mail, for testing
+'''
+#
+# Future imports
+#
+from __future__ import print_function
+#
+# Standard imports
+#
+import argparse
+import logging
+try:
+    from pathlib import Path
+except ModuleNotFoundError:
+    # Python 2.x? Add pathlib2 to your requirements.txt
+    from pathlib2 import Path
+import random
+import socketserver
+import threading
+import time
+#
+# Non-standard imports
+#
+
+#
+##############################################################################
+#
+# Global variables
+#
+DEFAULT_LOG_LEVEL = 'WARNING'
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 2525
+
+HELP_MESSAGE = '''
+Run a local SMTP server that accepts every message and throws it away, so
+send_emails() and the pooled or async senders can be measured without a real
+mail server. Point SMTP_SERVER/SMTP_PORT at it and set SMTP_STARTTLS: false.
+Any USERNAME/PASSWORD is accepted.
+
+Latency and failures can be injected to mimic a slow or throttling relay.
+'''
+#
+##############################################################################
+#
+# _get_logger() - reuable code to get the correct logger by name
+#
+def _get_logger():
+    '''
+    Reusable code to get the correct logger by name of current file
+
+    Returns:
+        logging.logger: Instance of logger for name of current file
+    '''
+    return logging.getLogger(Path(__file__).resolve().name)
+
+
+#
+##############################################################################
+#
+# _SinkHandler()
+#
+class _SinkHandler(socketserver.StreamRequestHandler):
+    '''
+    _SinkHandler - speaks just enough SMTP for smtplib, one connection each
+    '''
+    # multi-line replies are written line by line, don't let them wait on ACKs
+    disable_nagle_algorithm = True
+
+    def _reply(self, line):
+        self.wfile.write((line + "\r\n").encode('ascii'))
+
+    def _recv(self):
+        '''the next raw line, b'' once the client hung up or reset the connection'''
+        try:
+            return self.rfile.readline()
+        except ConnectionResetError:
+            return b''
+
+    def _readline(self):
+        '''the next line without its line ending, or None once the client hung up'''
+        raw = self._recv()
+        if not raw:
+            return None
+        return raw.decode('utf-8', 'replace').rstrip("\r\n")
+
+    def handle(self):
+        sink = self.server.sink
+        sink.connected()
+        self._reply("220 {0} smtp_sink ready".format(sink.host))
+        recipients = []
+        while True:
+            line = self._readline()
+            if None in [line]:
+                return
+            verb = line.split(' ', 1)[0].upper()
+            if verb == 'QUIT':
+                self._reply("221 Bye")
+                return
+            if verb == '':
+                self._reply("500 Command not recognized")
+            elif verb == 'EHLO':
+                self._reply("250-{0}".format(sink.host))
+                self._reply("250-AUTH PLAIN LOGIN")
+                self._reply("250 8BITMIME")
+            elif verb == 'HELO':
+                self._reply("250 {0}".format(sink.host))
+            elif verb == 'AUTH':
+                if not self._auth(line):
+                    return
+            elif verb == 'MAIL':
+                recipients = []
+                self._reply("250 OK")
+            elif verb == 'RCPT':
+                code = sink.fail()
+                if code:
+                    self._reply("{0} Injected failure".format(code))
+                else:
+                    recipients.append(line.split(':', 1)[-1].strip())
+                    self._reply("250 OK")
+            elif verb == 'DATA':
+                if not self._data(recipients):
+                    return
+                recipients = []
+            elif verb in ('RSET', 'NOOP'):
+                recipients = []
+                self._reply("250 OK")
+            else:
+                self._reply("502 Command not implemented")
+
+    def _auth(self, line):
+        '''accept any credentials, False if the client hung up part way'''
+        parts = line.split()
+        mechanism = parts[1].upper() if len(parts) > 1 else ''
+        prompts = []
+        if mechanism == 'PLAIN' and len(parts) < 3:
+            prompts = ["334 "]
+        elif mechanism == 'LOGIN':
+            prompts = ["334 UGFzc3dvcmQ6"]
+            if len(parts) < 3:
+                prompts.insert(0, "334 VXNlcm5hbWU6")
+        for prompt in prompts:
+            self._reply(prompt)
+            if None in [self._readline()]:
+                return False
+        self._reply("235 Authentication successful")
+        return True
+
+    def _data(self, recipients):
+        '''read one message, False if the client hung up before the final dot'''
+        sink = self.server.sink
+        self._reply("354 End data with <CR><LF>.<CR><LF>")
+        size = 0
+        while True:
+            raw = self._recv()
+            if not raw:
+                return False
+            if raw in (b".\r\n", b".\n"):
+                break
+            size += len(raw)
+        if sink.latency:
+            time.sleep(sink.latency)
+        code = sink.fail()
+        if code:
+            self._reply("{0} Injected failure".format(code))
+        else:
+            sink.received(recipients, size)
+            self._reply("250 OK queued")
+        return True
+
+
+#
+##############################################################################
+#
+# _SinkServer()
+#
+class _SinkServer(socketserver.ThreadingTCPServer):
+    '''
+    _SinkServer - threaded server that can rebind a port right after a run
+    '''
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, sink):
+        super(_SinkServer, self).__init__(address, _SinkHandler)
+        self.sink = sink
+
+
+#
+##############################################################################
+#
+# SmtpSink()
+#
+class SmtpSink(object):
+    '''
+    SmtpSink - in-process SMTP server on a background thread
+
+    latency is slept before answering each message. fail_rate is the chance
+    that a RCPT or a finished DATA is answered with fail_code instead of 250.
+    port=0 picks a free port, read it back from .port after start().
+    '''
+    def __init__(self, host=DEFAULT_HOST, port=0, latency=0.0, fail_rate=0.0, fail_code=451,
+                 seed=None):
+        super(SmtpSink, self).__init__()
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.fail_code = fail_code
+
+        self.connections = 0
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+        self.failures = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        '''start() - listen and serve on a daemon thread'''
+        self._server = _SinkServer((self.host, self.port), self)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='smtp-sink')
+        self._thread.daemon = True
+        self._thread.start()
+        _get_logger().info("Listening on %s:%s", self.host, self.port)
+
+    def stop(self):
+        '''stop() - shut the server down'''
+        if None not in [self._server]:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def connected(self):
+        '''connected() - count a new connection'''
+        with self._lock:
+            self.connections += 1
+
+    def fail(self):
+        '''fail() - fail_code if this reply should be an injected failure, else None'''
+        with self._lock:
+            if self.fail_rate and self._random.random() < self.fail_rate:
+                self.failures += 1
+                return self.fail_code
+        return None
+
+    def received(self, recipients, size):
+        '''received() - count an accepted message'''
+        with self._lock:
+            self.messages += 1
+            self.recipients += len(recipients)
+            self.bytes += size
+
+    def stats(self):
+        '''stats() - counters so far'''
+        with self._lock:
+            return {
+                'connections': self.connections,
+                'messages': self.messages,
+                'recipients': self.recipients,
+                'bytes': self.bytes,
+                'failures': self.failures,
+            }
+
+
+#
+##############################################################################
+#
+# handle_arguments()
+#
+def handle_arguments():
+    '''
+    Handle CLI arguments
+
+    Returns:
+        parser.Namespace: Representation of the parsed arguments
+    '''
+    parser = argparse.ArgumentParser(description=HELP_MESSAGE)
+
+    parser.add_argument('-l', '--log-level', action='store', required=False,
+                        choices=["debug", "info", "warning", "error", "critical"],
+                        default=DEFAULT_LOG_LEVEL,
+                        help='Logging verbosity. Default: {}'.format(DEFAULT_LOG_LEVEL))
+
+    parser.add_argument('--host', action='store', required=False, default=DEFAULT_HOST,
+                        help='Address to listen on. Default: {}'.format(DEFAULT_HOST))
+
+    parser.add_argument('-p', '--port', action='store', required=False, type=int,
+                        default=DEFAULT_PORT,
+                        help='Port to listen on. Default: {}'.format(DEFAULT_PORT))
+
+    parser.add_argument('--latency', action='store', required=False, type=float, default=0.0,
+                        help='Seconds to wait before accepting each message. Default: 0')
+
+    parser.add_argument('--fail-rate', action='store', required=False, type=float, default=0.0,
+                        help='Chance of answering RCPT or DATA with --fail-code. Default: 0')
+
+    parser.add_argument('--fail-code', action='store', required=False, type=int, default=451,
+                        help='Reply code for injected failures. Default: 451')
+
+    return parser.parse_args()
+
+
+#
+##############################################################################
+#
+# main
+#
+def main():
+    '''main() - Run the sink until interrupted'''
+    args = handle_arguments()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s:%(name)s.%(funcName)s:%(message)s',
+                        level=getattr(logging, args.log_level.upper()))
+
+    sink = SmtpSink(host=args.host, port=args.port, latency=args.latency,
+                    fail_rate=args.fail_rate, fail_code=args.fail_code)
+    sink.start()
+    print("smtp_sink listening on {0}:{1}, Ctrl-C to stop".format(sink.host, sink.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.stop()
+        print(sink.stats())
+
+
+#
+##############################################################################
+#
+# do it
+#
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# -*- coding: utf8 -*-
+#
+'''
+test_config_cache.py - cached_config() against edits to config.yml and its roster
+'''
+#
+# Standard imports
+#
+import logging
+import os
+import tempfile
+import unittest
+from unittest import mock
+#
+# Local imports
+#
+import secret_santa
+
+#
+##############################################################################
+#
+# Global variables
+#
+CONFIG = '''
+SMTP_SERVER: 127.0.0.1
+SMTP_PORT: 2525
+USERNAME: santa
+PASSWORD: hohoho
+TIMEZONE: US/Eastern
+FROM: secret-santa@example.org
+SUBJECT: Your secret santa recipient is {santee}
+MESSAGE: Dear {santa}, you are getting {santee} a gift.
+PARTICIPANTS_FILE: roster.csv
+'''
+
+ROSTER = 'name,email\nA,a@example.org\nB,b@example.org\n'
+
+
+#
+##############################################################################
+#
+# ConfigCacheTest()
+#
+class ConfigCacheTest(unittest.TestCase):
+    '''
+    ConfigCacheTest - a cache hit never hands back stale participants
+    '''
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = os.path.join(self.directory.name, 'config.yml')
+        self.roster = os.path.join(self.directory.name, 'roster.csv')
+        with open(self.config, 'w', encoding='utf-8') as handle:
+            handle.write(CONFIG)
+        with open(self.roster, 'w', encoding='utf-8') as handle:
+            handle.write(ROSTER)
+        cache = mock.patch.object(secret_santa, 'CACHE_PATH',
+                                  os.path.join(self.directory.name, '.config.cache'))
+        cache.start()
+        self.addCleanup(cache.stop)
+
+    def tearDown(self):
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    def _names(self):
+        _, givers = secret_santa.cached_config(self.config)
+        return [person.name for person in givers]
+
+    def test_hit(self):
+        '''an unchanged config is served from the cache'''
+        self.assertEqual(self._names(), ['A', 'B'])
+        with mock.patch.object(secret_santa, 'load_config') as load_config:
+            self.assertEqual(self._names(), ['A', 'B'])
+        load_config.assert_not_called()
+
+    def test_roster_edited(self):
+        '''a roster edited after it was cached is read again'''
+        self.assertEqual(self._names(), ['A', 'B'])
+        with open(self.roster, 'a', encoding='utf-8') as handle:
+            handle.write('C,c@example.org\n')
+        self.assertEqual(self._names(), ['A', 'B', 'C'])
+
+    def test_roster_edited_while_loading(self):
+        '''a roster edited after it was read but before the cache was written is a miss'''
+        read = secret_santa.load_participants
+
+        def edit_after_reading(path):
+            yield from read(path)
+            with open(path, 'a', encoding='utf-8') as handle:
+                handle.write('C,c@example.org\n')
+
+        with mock.patch.object(secret_santa, 'load_participants', edit_after_reading):
+            self.assertEqual(self._names(), ['A', 'B'])
+        self.assertEqual(self._names(), ['A', 'B', 'C'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+# -*- coding: utf8 -*-
+#
+'''
+test_journal.py - SendJournal and --resume, sending to smtp_sink.py
+'''
+#
+# Standard imports
+#
+import logging
+import tempfile
+import unittest
+#
+# Local imports
+#
+from SecretSanta import Pair, Person, SendJournal
+import secret_santa
+from smtp_sink import SmtpSink
+
+#
+##############################################################################
+#
+# Global variables
+#
+PAIRS = [{'giver': 'giver{0}'.format(idx)} for idx in range(4)]
+
+PEOPLE = 12
+
+
+#
+##############################################################################
+#
+# _RecordingSink()
+#
+class _RecordingSink(SmtpSink):
+    '''
+    _RecordingSink - SmtpSink that remembers who every message went to
+    '''
+    def __init__(self, **kwargs):
+        super(_RecordingSink, self).__init__(**kwargs)
+        self.delivered = []
+
+    def received(self, recipients, size):
+        super(_RecordingSink, self).received(recipients, size)
+        with self._lock:
+            self.delivered.extend(recipient.strip('<>') for recipient in recipients)
+
+
+#
+##############################################################################
+#
+# _people() / _config() - fixtures
+#
+def _people(count=PEOPLE):
+    '''a ring of Person, each giving to the next'''
+    people = [Person('Person {0}'.format(idx), 'person{0}@example.org'.format(idx), None)
+              for idx in range(count)]
+    return people, [Pair(giver, people[(idx + 1) % count]) for idx, giver in enumerate(people)]
+
+
+def _config(sink):
+    '''config.yml settings pointing at sink'''
+    return {
+        'SMTP_SERVER': sink.host,
+        'SMTP_PORT': sink.port,
+        'USERNAME': 'santa',
+        'PASSWORD': 'hohoho',
+        'SMTP_STARTTLS': False,
+        'SMTP_POOL_SIZE': 2,
+        'SMTP_RETRIES': 0,
+        'SMTP_TIMEOUT': 5,
+        'TIMEZONE': 'US/Eastern',
+        'FROM': 'secret-santa@example.org',
+        'SUBJECT': 'Your secret santa recipient is {santee}',
+        'MESSAGE': 'Dear {santa}, you are getting {santee} a gift.',
+    }
+
+
+#
+##############################################################################
+#
+# SendJournalTest()
+#
+class SendJournalTest(unittest.TestCase):
+    '''
+    SendJournalTest - a crash never makes a resumed run send twice
+    '''
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    def _crash(self, tail):
+        '''a journal that delivered pair 0 and died while writing tail'''
+        journal = SendJournal.create(self.directory.name, 'run-1', PAIRS)
+        journal.record(0)
+        journal.close()
+        with open(journal.path, 'a', encoding='utf-8') as handle:
+            handle.write(tail)
+
+    def _resume(self):
+        '''reload, deliver pairs 1 and 2, reload again'''
+        journal = SendJournal.load(self.directory.name, 'run-1')
+        pending = journal.pending()
+        journal.record(1)
+        journal.record(2)
+        journal.close()
+        return pending, SendJournal.load(self.directory.name, 'run-1').pending()
+
+    def test_torn_last_line(self):
+        '''a half written record is dropped, not glued to the next one'''
+        self._crash('{"pair": 1, "ty')
+        self.assertEqual(self._resume(), ([1, 2, 3], [3]))
+
+    def test_unterminated_last_line(self):
+        '''a whole record missing only its newline still counts'''
+        self._crash('{"pair": 1, "type": "sent"}')
+        self.assertEqual(self._resume(), ([2, 3], [3]))
+
+    def test_resume_round_trip(self):
+        '''failed messages stay pending in the journal and are sent on resume'''
+        people, pairs = _people()
+        emails = sorted(person.email for person in people)
+
+        journal = SendJournal.create(self.directory.name, 'run-1',
+                                     secret_santa.journal_pairs(pairs))
+        with _RecordingSink(fail_rate=0.4, fail_code=550, seed=7) as sink:
+            with self.assertRaises(RuntimeError):
+                secret_santa.send_emails(_config(sink), pairs, fake=False, journal=journal)
+            first = list(sink.delivered)
+        self.assertTrue(0 < len(first) < PEOPLE)
+
+        journal = SendJournal.load(self.directory.name, 'run-1')
+        self.assertEqual(sorted(pairs[idx].giver.email for idx in journal.pending()),
+                         sorted(set(emails) - set(first)))
+
+        restored = secret_santa.restore_pairs(journal.pairs, people)
+        self.assertEqual([(pair.giver, pair.reciever) for pair in restored],
+                         [(pair.giver, pair.reciever) for pair in pairs])
+        with _RecordingSink() as sink:
+            secret_santa.send_emails(_config(sink), restored, fake=False, journal=journal)
+            second = list(sink.delivered)
+
+        self.assertEqual(sorted(first + second), emails)
+        self.assertEqual(SendJournal.load(self.directory.name, 'run-1').pending(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# -*- coding: utf8 -*-
+#
+'''
+test_messages.py - MessageFactory output against the MIMEText it replaced
+'''
+#
+# Standard imports
+#
+from email.mime.text import MIMEText
+import random
+import unittest
+#
+# Non-standard imports
+#
+import pytz
+#
+# Local imports
+#
+from SecretSanta import MessageFactory, Pair, Person
+
+#
+##############################################################################
+#
+# Global variables
+#
+FUZZ_MESSAGES = 3000
+
+# mixed into names and templates: accents, CJK, emoji, quotes and folding bait
+ALPHABET = (
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 .,'-_\"()<>@"
+    "éèüößñçøåÆŒĳ" "ĄŁŻ" "Привет" "中文名字" "日本語" "😀🎅🎁"
+)
+
+DATE = 'Sun, 21 Dec 2008 06:25:23 EST'
+MESSAGE_ID = '<1229858723.4242.deadbeef.1@example.org>'
+
+
+#
+##############################################################################
+#
+# _FixedFactory()
+#
+class _FixedFactory(MessageFactory):
+    '''
+    _FixedFactory - MessageFactory with a fixed Date and Message-Id
+    '''
+    def date(self):
+        return DATE
+
+    def message_id(self):
+        return MESSAGE_ID
+
+
+#
+##############################################################################
+#
+# MessageFactoryTest()
+#
+class MessageFactoryTest(unittest.TestCase):
+    '''
+    MessageFactoryTest - build() must match MIMEText.as_string() byte for byte
+    '''
+    def _text(self, rng, longest):
+        return ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(1, longest)))
+
+    def _expected(self, sender, subject, message, pair):
+        '''the message as send_emails() built it with MIMEText'''
+        mesg = MIMEText(pair.generate_email(message=message).encode('utf-8'), _charset='utf-8')
+        mesg['Date'] = DATE
+        mesg['Message-Id'] = MESSAGE_ID
+        mesg['From'] = '"{name}" <{email}>'.format(name="Secret Santa", email=sender)
+        mesg['To'] = '"{name}" <{email}>'.format(name=pair.giver.name, email=pair.giver.email)
+        mesg['Subject'] = subject.format(santa=pair.giver.name, santee=pair.reciever.name)
+        return mesg.as_string()
+
+    def test_matches_mimetext(self):
+        '''build() matches MIMEText for random non-ASCII names and templates'''
+        rng = random.Random(2018)
+        time_zone = pytz.timezone('US/Eastern')
+        for number in range(FUZZ_MESSAGES):
+            sender = 'secret-santa@example.org'
+            subject = '{0} {{santee}} {1}'.format(self._text(rng, 10), self._text(rng, 60))
+            message = 'Dear {{santa}},\n\n{0}\n\n    {{wish_list}}\n{1}'.format(
+                self._text(rng, 200), self._text(rng, 20))
+            giver = Person(self._text(rng, 80), 'giver{0}@example.org'.format(number), None)
+            reciever = Person(self._text(rng, 80), 'reciever{0}@example.org'.format(number), None,
+                              wish_list=rng.choice([None, self._text(rng, 100)]))
+            pair = Pair(giver, reciever)
+
+            factory = _FixedFactory(sender, subject, message, time_zone, hostname='example.org')
+            self.assertEqual(factory.build(pair), self._expected(sender, subject, message, pair),
+                             "message {0} differs".format(number))
+
+
+if __name__ == '__main__':
+    unittest.main()
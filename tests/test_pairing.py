@@ -0,0 +1,276 @@
+# -*- coding: utf8 -*-
+#
+'''
+test_pairing.py - pairing engines against a brute force over every permutation
+'''
+#
+# Standard imports
+#
+import itertools
+import logging
+import math
+import random
+import unittest
+#
+# Non-standard imports
+#
+try:
+    import numpy
+except ImportError:
+    # optional, only NumpyPairing needs it
+    numpy = None
+#
+# Local imports
+#
+from SecretSanta import DerangementSampler, ExclusionIndex, Matcher, NumpyPairing, Person
+import secret_santa
+
+#
+##############################################################################
+#
+# Global variables
+#
+GRAPHS = 300
+MAX_PEOPLE = 7
+
+# sample() budget, in multiples of the expected tries for one valid draw
+TRY_FACTOR = 20
+
+# draws per valid assignment in the uniformity check
+UNIFORM_DRAWS = 400
+
+# create_pairs() runs per roster, it shuffles with the global random
+REPEATS = 3
+
+
+#
+##############################################################################
+#
+# _cases() - fixtures
+#
+def _cases(seed=2018):
+    '''
+    random rosters of 2 to MAX_PEOPLE people, each with its valid assignments
+
+    Exclusion density is drawn per roster so both easy and impossible
+    rosters turn up.
+    '''
+    rng = random.Random(seed)
+    cases = []
+    for _ in range(GRAPHS):
+        size = rng.randint(2, MAX_PEOPLE)
+        density = rng.random()
+        names = ['P{0}'.format(idx) for idx in range(size)]
+        people = [Person(name, name.lower() + '@example.org',
+                         [other for other in names if other != name and rng.random() < density])
+                  for name in names]
+        ExclusionIndex(people)
+        valid = [order for order in itertools.permutations(range(size))
+                 if all(people[giver].can_give_to(people[reciever])
+                        for giver, reciever in enumerate(order))]
+        cases.append((people, valid))
+    return cases
+
+
+#
+##############################################################################
+#
+# _PairingTest()
+#
+class _PairingTest(unittest.TestCase):
+    '''
+    _PairingTest - shared rosters and checks for the engine tests
+    '''
+    cases = []
+
+    @classmethod
+    def setUpClass(cls):
+        if not _PairingTest.cases:
+            _PairingTest.cases = _cases()
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        random.seed(7)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def assert_valid(self, people, assignment):
+        '''assignment is a full list of (giver, reciever) index pairs that is allowed'''
+        self.assertEqual(sorted(giver for giver, _ in assignment), list(range(len(people))))
+        self.assertEqual(sorted(reciever for _, reciever in assignment), list(range(len(people))))
+        for giver, reciever in assignment:
+            self.assertTrue(people[giver].can_give_to(people[reciever]))
+
+
+#
+##############################################################################
+#
+# MatcherTest()
+#
+class MatcherTest(_PairingTest):
+    '''
+    MatcherTest - a full matching exactly when some valid permutation exists
+    '''
+    def test_cases(self):
+        '''the rosters include both possible and impossible ones'''
+        feasible = sum(1 for _, valid in self.cases if valid)
+        self.assertTrue(0 < feasible < len(self.cases))
+
+    def test_assignment(self):
+        '''assignment() is valid when possible and None otherwise'''
+        for number, (people, valid) in enumerate(self.cases):
+            matcher = Matcher(people, people[:], rng=random.Random(number))
+            matched = matcher.match()
+            assignment = matcher.assignment()
+            if valid:
+                self.assertEqual(matched, len(people))
+                self.assert_valid(people, assignment)
+            else:
+                self.assertLess(matched, len(people))
+                self.assertIsNone(assignment)
+
+
+#
+##############################################################################
+#
+# DerangementSamplerTest()
+#
+class DerangementSamplerTest(_PairingTest):
+    '''
+    DerangementSamplerTest - a valid draw when one exists, None otherwise
+    '''
+    def test_sample(self):
+        '''sample() finds an assignment given enough tries and never returns a bad one'''
+        for number, (people, valid) in enumerate(self.cases):
+            tries = TRY_FACTOR * math.factorial(len(people)) // len(valid) if valid else 100
+            sampler = DerangementSampler(people, people[:], max_tries=tries,
+                                         rng=random.Random(number))
+            assignment = sampler.sample()
+            if valid:
+                self.assert_valid(people, assignment)
+            else:
+                self.assertIsNone(assignment)
+                self.assertEqual(sampler.tries, tries)
+
+    def test_uniform(self):
+        '''every valid assignment is drawn about equally often'''
+        people, valid = next((people, valid) for people, valid in self.cases
+                             if len(people) == 5 and len(valid) > 5)
+        draws = UNIFORM_DRAWS * len(valid)
+        sampler = DerangementSampler(people, people[:], max_tries=draws, rng=random.Random(11))
+        counts = dict.fromkeys(valid, 0)
+        for _ in range(draws):
+            counts[tuple(reciever for _, reciever in sampler.sample())] += 1
+        self.assertEqual(sum(counts.values()), draws)
+        # +-30% is about six standard deviations
+        self.assertTrue(all(abs(count - UNIFORM_DRAWS) < 0.3 * UNIFORM_DRAWS
+                            for count in counts.values()), counts)
+
+
+
+#
+##############################################################################
+#
+# DeadlockTest()
+#
+class DeadlockTest(_PairingTest):
+    '''
+    DeadlockTest - deadlock() names k people with fewer than k options
+    '''
+    def test_witness(self):
+        '''a Hall's condition witness exactly when no valid permutation exists'''
+        for number, (people, valid) in enumerate(self.cases):
+            matcher = Matcher(people, people[:], rng=random.Random(number))
+            matcher.match()
+            witness = matcher.deadlock()
+            if valid:
+                self.assertIsNone(witness)
+                continue
+
+            side, stuck, options = witness
+            self.assertEqual(len(set(stuck)), len(stuck))
+            self.assertLess(len(options), len(stuck))
+            everyone = range(len(people))
+            if side == 'giver':
+                reach = {reciever for giver in stuck for reciever in everyone
+                         if people[giver].can_give_to(people[reciever])}
+            else:
+                self.assertEqual(side, 'reciever')
+                reach = {giver for reciever in stuck for giver in everyone
+                         if people[giver].can_give_to(people[reciever])}
+            self.assertEqual(sorted(options), sorted(reach))
+
+
+
+#
+##############################################################################
+#
+# NumpyPairingTest()
+#
+@unittest.skipIf(None in [numpy], "NumpyPairing needs numpy")
+class NumpyPairingTest(_PairingTest):
+    '''
+    NumpyPairingTest - draws and repairs never hand back a forbidden pair
+    '''
+    def test_sample(self):
+        '''sample() finds an assignment given enough tries, None when there is none'''
+        for number, (people, valid) in enumerate(self.cases):
+            tries = TRY_FACTOR * math.factorial(len(people)) // len(valid) if valid else 100
+            order = NumpyPairing(people, people[:], seed=number).sample(max_tries=tries)
+            if valid:
+                self.assert_valid(people, list(enumerate(order.tolist())))
+            else:
+                self.assertIsNone(order)
+
+    def test_repair(self):
+        '''repair() gives a valid order or up, and always gives up when there is none
+
+        Swapping two recievers cannot undo every bad draw (a three way
+        rotation may be needed), so repair() may give up on possible rosters
+        too; numpy_pairs() falls back to the matching then.
+        '''
+        repaired = 0
+        for number, (people, valid) in enumerate(self.cases):
+            order = NumpyPairing(people, people[:], seed=number).repair(max_rounds=50)
+            if order is None:
+                continue
+            self.assertTrue(valid)
+            self.assert_valid(people, list(enumerate(order.tolist())))
+            repaired += 1
+        self.assertGreater(repaired, 0)
+
+
+
+#
+##############################################################################
+#
+# CreatePairsTest()
+#
+class CreatePairsTest(_PairingTest):
+    '''
+    CreatePairsTest - repairing dead ends pairs everyone whenever possible
+    '''
+    def _check(self, order):
+        '''create_pairs() succeeds exactly when some valid permutation exists'''
+        for people, valid in self.cases:
+            for _ in range(REPEATS):
+                if not valid:
+                    with self.assertRaises(RuntimeError):
+                        secret_santa.create_pairs(people, people[:], order=order)
+                    continue
+                pairs = secret_santa.create_pairs(people, people[:], order=order)
+                self.assert_valid(people, [(people.index(pair.giver), people.index(pair.reciever))
+                                           for pair in pairs])
+
+    def test_random_order(self):
+        '''givers in random order'''
+        self._check('random')
+
+    def test_mrv_order(self):
+        '''givers with the fewest recievers left first (GiverQueue)'''
+        self._check('mrv')
+
+
+if __name__ == '__main__':
+    unittest.main()
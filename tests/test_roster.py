@@ -0,0 +1,57 @@
+# -*- coding: utf8 -*-
+#
+'''
+test_roster.py - load_participants() on CSV and YAML rosters
+'''
+#
+# Standard imports
+#
+import os
+import tempfile
+import unittest
+#
+# Local imports
+#
+import secret_santa
+
+
+#
+##############################################################################
+#
+# RosterTest()
+#
+class RosterTest(unittest.TestCase):
+    '''
+    RosterTest - every participant in the file is read, or loading fails
+    '''
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _load(self, name, data):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'wb') as handle:
+            handle.write(data)
+        return [person.name for person in secret_santa.load_participants(path)]
+
+    def test_csv_byte_order_mark(self):
+        '''a CSV saved with a UTF-8 BOM (Excel) reads its name column'''
+        self.assertEqual(self._load('roster.csv', b'\xef\xbb\xbfname,email\nJen,jen@example.org\n'),
+                         ['Jen'])
+
+    def test_yaml_document_markers(self):
+        '''explicit --- and ... around the one list are fine'''
+        data = b'---\n- {name: A, email: a@example.org}\n- {name: B, email: b@example.org}\n...\n'
+        self.assertEqual(self._load('roster.yml', data), ['A', 'B'])
+
+    def test_yaml_second_document(self):
+        '''people in a second document are an error, not silently dropped'''
+        data = b'- {name: A, email: a@example.org}\n---\n- {name: B, email: b@example.org}\n'
+        with self.assertRaises(RuntimeError):
+            self._load('roster.yml', data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf8 -*-
+#
+'''
+test_smtp_pool.py - SmtpPool failure paths against smtp_sink.py
+'''
+#
+# Standard imports
+#
+import logging
+import smtplib
+import unittest
+#
+# Local imports
+#
+from SecretSanta import SmtpPool
+from smtp_sink import SmtpSink
+
+#
+##############################################################################
+#
+# Global variables
+#
+MESSAGES = 12
+
+# submit() labels, sorted
+LABELS = ['to{0:02d}'.format(idx) for idx in range(MESSAGES)]
+
+
+#
+##############################################################################
+#
+# SmtpPoolTest()
+#
+class SmtpPoolTest(unittest.TestCase):
+    '''
+    SmtpPoolTest - failed sends are retried, recorded and never hang the pool
+    '''
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.results = []
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def _pool(self, sink, cls=SmtpPool, **kwargs):
+        pool = cls(sink.host, sink.port, 'santa', 'hohoho', starttls=False, size=2, timeout=5,
+                   on_result=lambda label, err: self.results.append((label, err)), **kwargs)
+        pool.start()
+        return pool
+
+    def test_transient_failures(self):
+        '''4xx replies are retried, then recorded as failures'''
+        with SmtpSink(fail_rate=1.0, fail_code=451) as sink:
+            pool = self._pool(sink, max_retries=2, backoff=0.001)
+            for label in LABELS[:5]:
+                pool.submit('santa@example.org', [label + '@example.org'], 'hi', label)
+            pool.close()
+
+        self.assertEqual(pool.sent, 0)
+        self.assertEqual(pool.retries, 10)
+        self.assertEqual(sorted(label for label, _ in pool.failures), LABELS[:5])
+        self.assertEqual(sorted(label for label, err in self.results if err), LABELS[:5])
+
+    def test_permanent_failures(self):
+        '''5xx replies are not retried'''
+        with SmtpSink(fail_rate=1.0, fail_code=550) as sink:
+            pool = self._pool(sink, max_retries=2, backoff=0.001)
+            for label in LABELS[:5]:
+                pool.submit('santa@example.org', [label + '@example.org'], 'hi', label)
+            pool.close()
+
+        self.assertEqual(pool.retries, 0)
+        self.assertEqual(len(pool.failures), 5)
+
+    def test_unencodable_address(self):
+        '''an address smtplib cannot send fails alone instead of killing a worker'''
+        with SmtpSink() as sink:
+            pool = self._pool(sink, queue_size=1)
+            for idx, label in enumerate(LABELS):
+                user = label.replace('o', 'ö') if idx % 2 else label
+                pool.submit('santa@example.org', [user + '@example.org'], 'hi', label)
+            pool.close()
+            delivered = sink.stats()['messages']
+
+        self.assertEqual(pool.sent, MESSAGES // 2)
+        self.assertEqual(delivered, MESSAGES // 2)
+        self.assertEqual(sorted(label for label, _ in pool.failures), LABELS[1::2])
+
+    def test_refused_login(self):
+        '''a refused login fails everything after one attempt and close() raises'''
+        logins = []
+
+        class _BadLogin(SmtpPool):
+            def _connect(self):
+                logins.append(1)
+                raise smtplib.SMTPAuthenticationError(535, b'5.7.8 bad credentials')
+
+        with SmtpSink() as sink:
+            pool = self._pool(sink, cls=_BadLogin, max_retries=3)
+            for label in LABELS:
+                pool.submit('santa@example.org', [label + '@example.org'], 'hi', label)
+            with self.assertRaises(RuntimeError):
+                pool.close()
+
+        self.assertEqual(len(logins), 1)
+        self.assertEqual(len(pool.failures), MESSAGES)
+        self.assertTrue(all(err for _, err in self.results))
+
+
+if __name__ == '__main__':
+    unittest.main()
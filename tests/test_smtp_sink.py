@@ -0,0 +1,69 @@
+# -*- coding: utf8 -*-
+#
+'''
+test_smtp_sink.py - smtp_sink.py with clients that misbehave
+'''
+#
+# Standard imports
+#
+import contextlib
+import io
+import socket
+import struct
+import unittest
+#
+# Local imports
+#
+from smtp_sink import SmtpSink
+
+
+#
+##############################################################################
+#
+# SmtpSinkTest()
+#
+class SmtpSinkTest(unittest.TestCase):
+    '''
+    SmtpSinkTest - the sink answers blank lines and lets clients hang up
+    '''
+    def _session(self, sink, lines, reset=False):
+        '''send lines, read the whole reply to each, then hang up without QUIT'''
+        client = socket.create_connection((sink.host, sink.port), timeout=5)
+        replies = client.makefile('rb')
+        replies.readline()
+        seen = []
+        for line in lines:
+            client.sendall(line)
+            reply = replies.readline()
+            while reply[3:4] == b'-':
+                reply = replies.readline()
+            seen.append(reply[:3])
+        if reset:
+            # close with RST so any reply written afterwards hits a dead socket
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        replies.close()
+        client.close()
+        return seen
+
+    def test_blank_line(self):
+        '''a blank line is an unknown command, not QUIT'''
+        with SmtpSink() as sink:
+            self.assertEqual(self._session(sink, [b"\r\n", b"NOOP\r\n"]), [b"500", b"250"])
+
+    def test_hang_up(self):
+        '''clients that disconnect mid session leave no handler tracebacks'''
+        errors = io.StringIO()
+        with contextlib.redirect_stderr(errors):
+            with SmtpSink() as sink:
+                for _ in range(20):
+                    self._session(sink, [b"EHLO test\r\n"], reset=True)
+                    self._session(sink, [b"MAIL FROM:<a@example.org>\r\n",
+                                         b"RCPT TO:<b@example.org>\r\n",
+                                         b"DATA\r\n"], reset=True)
+                stats = sink.stats()
+        self.assertEqual(errors.getvalue(), '')
+        self.assertEqual(stats['messages'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()